@@ -0,0 +1,187 @@
+# Файл: bench/fake_servers.py
+"""
+Локальные заглушки Sitniks CRM и Новой Почты для бенчмарков.
+
+CRM:  GET  /crm/orders?skip=&limit=&dateFrom=&dateTo=  (как /orders у Sitniks)
+НП:   POST /np/  (TrackingDocument.getStatusDocuments)
+
+Заказы синтетические и детерминированные: заказ i всегда одинаковый,
+поэтому в памяти ничего не храним, даже на 200k заказов.
+"""
+import math
+import random
+import asyncio
+from datetime import datetime, timedelta
+
+from aiohttp import web
+
+STATUSES = [
+    "Перевірити обмін", "Очікує обмін", "Обмін підтверджено", "Виконано",
+    "Відмінено", "ТТН сформовано", "Запаковано", "Відправлено",
+]
+PRODUCTS = ["Футболка", "Худі", "Кепка", "Шкарпетки", "Рюкзак", "Світшот"]
+TTN_PREFIX = "2045"
+
+
+class FakeData:
+    """Синтетические заказы, равномерно за последние window_days дней."""
+
+    def __init__(self, total_orders, window_days=60, seed=42):
+        self.total = total_orders
+        self.window_days = window_days
+        self.seed = seed
+        self.now = datetime.now().replace(microsecond=0)
+        self.start = self.now - timedelta(days=window_days)
+        self.step = timedelta(days=window_days) / max(total_orders, 1)
+
+    def created_at(self, i):
+        return self.start + self.step * i
+
+    def order(self, i):
+        rnd = random.Random(self.seed * 1_000_003 + i)
+        created = self.created_at(i)
+        updated = min(created + timedelta(hours=rnd.randint(0, 72)), self.now)
+        status = rnd.choice(STATUSES)
+        order = {
+            'id': i + 1,
+            'orderNumber': 100000 + i,
+            'createdAt': created.isoformat() + 'Z',
+            'updatedAt': updated.isoformat() + 'Z',
+            'completedAt': updated.isoformat() + 'Z' if status == "Виконано" else None,
+            'status': {'id': STATUSES.index(status), 'title': status},
+            'totalPrice': rnd.randint(200, 5000),
+            'client': {'fullname': f"Клієнт {i}", 'phone': f"+38050{i:07d}"[:13]},
+            'products': [
+                {'title': rnd.choice(PRODUCTS), 'quantity': 1, 'price': rnd.randint(100, 2000)}
+                for _ in range(rnd.randint(1, 3))
+            ],
+            'delivery': {'billOfLading': None},
+        }
+        if rnd.random() < 0.8:
+            order['delivery']['billOfLading'] = self.ttn(i)
+        return order
+
+    def ttn(self, i):
+        return f"{TTN_PREFIX}{i:010d}"
+
+    def ttn_index(self, ttn):
+        if not ttn.startswith(TTN_PREFIX):
+            return None
+        try:
+            i = int(ttn[len(TTN_PREFIX):])
+        except ValueError:
+            return None
+        return i if 0 <= i < self.total else None
+
+    def tracking(self, ttn):
+        i = self.ttn_index(ttn)
+        if i is None:
+            return {'Number': ttn, 'StatusCode': '3', 'Status': 'Номер не знайдено'}
+        rnd = random.Random(self.seed * 7_000_003 + i)
+        created = self.created_at(i)
+        if rnd.random() < 0.05:
+            return {'Number': ttn, 'StatusCode': '1', 'DateCreated': created.strftime("%d-%m-%Y %H:%M:%S")}
+        scan = min(created + timedelta(hours=rnd.randint(1, 40)), self.now)
+        return {
+            'Number': ttn,
+            'StatusCode': '9',
+            'DateCreated': created.strftime("%d-%m-%Y %H:%M:%S"),
+            'DateScan': scan.strftime("%H:%M %d.%m.%Y"),
+        }
+
+    def order_range(self, date_from, date_to):
+        """Индексы [first, last) заказов, созданных в date_from..date_to (включительно)."""
+        lo = datetime.combine(date_from, datetime.min.time())
+        hi = datetime.combine(date_to + timedelta(days=1), datetime.min.time())
+        step = self.step.total_seconds() or 1
+        first = math.ceil((lo - self.start).total_seconds() / step)
+        last = math.ceil((hi - self.start).total_seconds() / step)
+        first = min(max(first, 0), self.total)
+        last = min(max(last, first), self.total)
+        return first, last
+
+
+class FakeServers:
+    """aiohttp-приложение с обеими заглушками + счетчики запросов."""
+
+    def __init__(self, data, latency=0.0, error_rate=0.0, port=8799):
+        self.data = data
+        self.latency = latency
+        self.error_rate = error_rate
+        self.port = port
+        self.requests = {'crm': 0, 'np': 0, 'errors': 0}
+        self._rnd = random.Random(1)
+        self._runner = None
+
+    @property
+    def crm_url(self):
+        return f"http://127.0.0.1:{self.port}/crm"
+
+    @property
+    def np_url(self):
+        return f"http://127.0.0.1:{self.port}/np/"
+
+    async def _delay_or_fail(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and self._rnd.random() < self.error_rate:
+            self.requests['errors'] += 1
+            status = self._rnd.choice([429, 502, 503])
+            return web.Response(status=status, text="fake error", headers={'Retry-After': '0'})
+        return None
+
+    async def orders(self, request):
+        self.requests['crm'] += 1
+        error = await self._delay_or_fail()
+        if error:
+            return error
+        skip = int(request.query.get('skip', 0))
+        limit = int(request.query.get('limit', 50))
+        date_from = datetime.strptime(request.query['dateFrom'], '%Y-%m-%d').date()
+        date_to = datetime.strptime(request.query['dateTo'], '%Y-%m-%d').date()
+        first, last = self.data.order_range(date_from, date_to)
+        start = first + skip
+        batch = [self.data.order(i) for i in range(start, min(start + limit, last))]
+        return web.json_response({'data': batch, 'total': last - first})
+
+    async def tracking(self, request):
+        self.requests['np'] += 1
+        error = await self._delay_or_fail()
+        if error:
+            return error
+        payload = await request.json()
+        documents = payload.get('methodProperties', {}).get('Documents', [])
+        return web.json_response({
+            'success': True,
+            'data': [self.data.tracking(d['DocumentNumber']) for d in documents],
+            'errors': [],
+        })
+
+    async def start(self):
+        app = web.Application()
+        app.add_routes([web.get('/crm/orders', self.orders), web.post('/np/', self.tracking)])
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", self.port).start()
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+
+async def _serve_forever(args):
+    servers = FakeServers(FakeData(args.orders), args.latency, args.error_rate, args.port)
+    await servers.start()
+    print(f"CRM_URL={servers.crm_url}")
+    print(f"NP_API_URL={servers.np_url}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Заглушки CRM и НП для ручной проверки бота")
+    parser.add_argument("--orders", type=int, default=10000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--port", type=int, default=8799)
+    asyncio.run(_serve_forever(parser.parse_args()))
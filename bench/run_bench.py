@@ -0,0 +1,159 @@
+# Файл: bench/run_bench.py
+"""
+Офлайн-бенчмарк горячих путей бота на заглушках CRM и НП (bench/fake_servers.py).
+
+    python bench/run_bench.py --scales 1000,10000,200000 --latency 0.02 --error-rate 0.01
+
+Для каждого масштаба (число заказов за 60 дней) меряем:
+  - отчет "Відправлено" за неделю: холодный (пустые зеркало и кэш ТТН) и теплый;
+  - отчет "Виконано" за неделю (без НП);
+  - get_tracking_dates на всех ТТН периода: холодный и из кэша;
+  - форматирование полного текста отчета;
+  - load_history за последние 30 дней целиком.
+Каждый масштаб работает в своей временной папке со своей bot_stats.db.
+Реальные CRM/НП не трогаются.
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_servers import FakeData, FakeServers
+
+NP_KEYS = 3
+
+
+def _configure_env(servers, np_rps):
+    """Клиенты читают настройки из окружения - подменяем до импорта services."""
+    os.environ["CRM_URL"] = servers.crm_url
+    os.environ["CRM_TOKEN"] = "bench"
+    os.environ["NP_API_URL"] = servers.np_url
+    for i in range(1, NP_KEYS + 1):
+        os.environ[f"NP_KEY_{i}"] = f"bench-key-{i:04d}"
+    os.environ["NP_KEY_RPS"] = str(np_rps)
+    os.environ["NP_KEY_BURST"] = str(max(2, int(np_rps)))
+    os.environ["NP_KEY_COOLDOWN"] = "0.1"
+
+
+async def _timed(results, name, coro):
+    started = time.perf_counter()
+    value = await coro
+    results.append((name, time.perf_counter() - started))
+    return value
+
+
+def _timed_sync(results, name, func, *args):
+    started = time.perf_counter()
+    value = func(*args)
+    results.append((name, time.perf_counter() - started))
+    return value
+
+
+async def bench_scale(total_orders, args):
+    from services.db import init_db, close_db
+    from services.http_client import create_http_session
+    from services.crm_api import SitniksAPI, slim_order
+    from services.order_store import order_ttn
+    from formatter import format_order_report
+    import load_history
+
+    data = FakeData(total_orders)
+    servers = FakeServers(data, args.latency, args.error_rate, args.port)
+    await servers.start()
+    results = []
+    try:
+        init_db()
+        today = datetime.now().date()
+        week_start = today - timedelta(days=7)
+        session = create_http_session()
+        try:
+            crm = SitniksAPI(session=session)
+            shipped = await _timed(results, "report відправлено 7d (cold)",
+                                   crm.get_report_orders(week_start, today, "Відправлено"))
+            await _timed(results, "report відправлено 7d (warm)",
+                         crm.get_report_orders(week_start, today, "Відправлено"))
+            await _timed(results, "report виконано 7d",
+                         crm.get_report_orders(week_start, today, "Виконано"))
+
+            ttns = []
+            async for order in crm.store.iter_orders(week_start - timedelta(days=14), today):
+                ttn = order_ttn(order)
+                if ttn:
+                    ttns.append(ttn)
+            # Холодный проход НП: кэш ТТН уже заполнен отчетом выше - чистим его
+            fresh = SitniksAPI(session=session)
+            _clear_ttn_cache()
+            await _timed(results, f"np tracking {len(ttns)} ttn (cold)",
+                         fresh.np_api.get_tracking_dates(ttns))
+            await _timed(results, f"np tracking {len(ttns)} ttn (cache)",
+                         fresh.np_api.get_tracking_dates(ttns))
+
+            slim = [slim_order(o) for o in shipped]
+            _timed_sync(results, f"format {len(slim)} orders", format_order_report,
+                        slim, f"{week_start} - {today}", "Відправлено")
+        finally:
+            await session.close()
+
+        logging.disable(logging.INFO)
+        _clear_ttn_cache()
+        await _timed(results, "load_history 30d",
+                     load_history.load_historical_data(today - timedelta(days=30), today - timedelta(days=1)))
+        logging.disable(logging.NOTSET)
+    finally:
+        close_db()
+        await servers.stop()
+    return results, dict(servers.requests)
+
+
+def _clear_ttn_cache():
+    import sqlite3
+    from services.db import DB_NAME
+    with sqlite3.connect(DB_NAME) as conn:
+        conn.execute("DELETE FROM ttn_cache")
+
+
+def _print_results(total_orders, results, requests):
+    print(f"\n=== {total_orders} заказов | запросов CRM: {requests['crm']}, "
+          f"НП: {requests['np']}, ошибок: {requests['errors']} ===")
+    width = max(len(name) for name, _ in results)
+    for name, seconds in results:
+        print(f"  {name.ljust(width)}  {seconds:9.3f} s")
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк отчетов на заглушках CRM и НП")
+    parser.add_argument("--scales", default="1000,10000",
+                        help="Масштабы (заказов за 60 дней) через запятую, напр. 1000,10000,200000")
+    parser.add_argument("--latency", type=float, default=0.0, help="Задержка ответа заглушек, сек")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля ответов 429/502/503")
+    parser.add_argument("--np-rps", type=float, default=50.0,
+                        help="Лимит запросов/сек на ключ НП (боевой - 2)")
+    parser.add_argument("--port", type=int, default=8799)
+    args = parser.parse_args()
+    args.scales = [int(s) for s in args.scales.split(",") if s.strip()]
+    return args
+
+
+async def main(args):
+    for total_orders in args.scales:
+        with tempfile.TemporaryDirectory(prefix="bot_bench_") as workdir:
+            os.chdir(workdir)
+            results, requests = await bench_scale(total_orders, args)
+            os.chdir(ROOT)
+        _print_results(total_orders, results, requests)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    args = _parse_args()
+    # Порт и URL заглушек известны заранее - окружение настраиваем до импорта services
+    _configure_env(FakeServers(None, port=args.port), args.np_rps)
+    asyncio.run(main(args))
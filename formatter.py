@@ -1,13 +1,19 @@
 # Файл: formatter.py
 from datetime import datetime
 
-def format_order_report(orders, period_str, filter_status=""):
+# Сколько заказов на одной странице отчета
+PAGE_SIZE = 10
+# Лимит Telegram на текст сообщения (с запасом)
+MESSAGE_LIMIT = 4000
+
+def format_report_summary(orders, period_str, filter_status=""):
+    """Шапка отчета: статус, период, итоги."""
     if not orders:
         return f"📅 Период: {period_str}\n❌ Заказов со статусом '{filter_status}' не найдено."
 
     total_count = len(orders)
     total_sum = sum(float(o.get('totalPrice', 0)) for o in orders)
-    
+
     icon = "📋"
     if "відправлено" in filter_status.lower(): icon = "🚚"
     elif "виконано" in filter_status.lower(): icon = "💰"
@@ -19,48 +25,226 @@ def format_order_report(orders, period_str, filter_status=""):
         f"💵 **На сумму: {total_sum:,.2f} UAH**".replace(",", " "),
         "──────────────────"
     ]
-    
+    return "\n".join(lines)
+
+def format_order_block(i, order, filter_status="", products_limit=None):
+    """Блок одного заказа в отчете."""
+    o_id = order.get('orderNumber') or order.get('id')
+    crm_status = order.get('status', {}).get('title', 'Неизвестно')
+
+    # Получаем дату сканирования (если есть)
+    confirmed_date = order.get('_confirmed_date')
+    date_str = confirmed_date.strftime('%d.%m') if confirmed_date else "?"
+
+    client = order.get('client', {}) or {}
+    client_name = client.get('fullname', 'Без имени')
+
+    # === ЛОГИКА ТОВАРОВ (НОВАЯ) ===
+    products = order.get('products', [])
+    if products:
+        # Собираем список всех названий
+        titles = [p.get('title', 'Без названия') for p in products]
+        if products_limit is not None and len(titles) > products_limit:
+            # Один заказ не должен быть длиннее страницы
+            titles = titles[:products_limit] + [f"… ещё {len(titles) - products_limit} товар(ов)"]
+        # Объединяем их через перенос строки + иконку
+        # Результат будет: "Товар 1\n📦 Товар 2\n📦 Товар 3"
+        prod_str = "\n📦 ".join(titles)
+    else:
+        prod_str = "Без товара"
+
+    ttn = order.get('delivery', {}).get('billOfLading') or \
+          order.get('npDelivery', {}).get('billOfLading') or \
+          "-"
+
+    # === ЛОГИКА СТАТУСОВ ===
+    status_info = f"ℹ️ CRM: {crm_status}"
+
+    if "відправлено" in filter_status.lower() and "відправлено" not in crm_status.lower():
+         status_info = f"⚠️ CRM: {crm_status} (но уехала {date_str})"
+
+    # Формируем блок
+    # Цена приклеится к последнему товару, это нормально выглядит
+    return (
+        f"**{i}. Заказ #{o_id}** | 👤 {client_name}\n"
+        f"📦 {prod_str} | 💰 {float(order.get('totalPrice', 0))} грн\n"
+        f"🎫 ТТН: `{ttn}`\n"
+        f"{status_info}"
+    )
+
+# Сколько символов заказов влезает на страницу (остальное - шапка отчета/страницы)
+PAGE_BUDGET = MESSAGE_LIMIT - 500
+PAGE_SEPARATOR = "\n─ ─ ─ ─ ─"
+
+def page_offsets(orders, filter_status="", page_size=PAGE_SIZE, budget=PAGE_BUDGET):
+    """
+    Индексы первых заказов каждой страницы: не больше page_size заказов
+    и не больше budget символов. Заказ, который не влез, начинает следующую страницу.
+    """
+    offsets = [0]
+    count = length = 0
+    for i, order in enumerate(orders):
+        size = len(format_order_block(i + 1, order, filter_status)) + len(PAGE_SEPARATOR) + 1
+        if count and (count == page_size or length + size > budget):
+            offsets.append(i)
+            count = length = 0
+        count += 1
+        length += size
+    return offsets
+
+def page_count(offsets):
+    return len(offsets)
+
+def _fitted_block(i, order, filter_status, budget):
+    """Блок заказа; если один заказ больше страницы - сокращаем список товаров."""
+    block = format_order_block(i, order, filter_status)
+    limit = len(order.get('products') or [])
+    while len(block) > budget and limit > 1:
+        limit //= 2
+        block = format_order_block(i, order, filter_status, products_limit=limit)
+    return block
+
+def format_report_page(orders, page, offsets, filter_status="", budget=PAGE_BUDGET):
+    """
+    Одна страница отчета (page с нуля, offsets - из page_offsets).
+    Форматируются только заказы этой страницы.
+    """
+    start = offsets[page]
+    end = offsets[page + 1] if page + 1 < len(offsets) else len(orders)
+    return "\n".join(
+        _fitted_block(i + 1, orders[i], filter_status, budget) + PAGE_SEPARATOR
+        for i in range(start, end)
+    )
+
+def format_order_report(orders, period_str, filter_status=""):
+    """Весь отчет одним текстом."""
+    summary = format_report_summary(orders, period_str, filter_status)
+    if not orders:
+        return summary
+
+    lines = [summary]
     for i, order in enumerate(orders, 1):
-        o_id = order.get('orderNumber') or order.get('id')
-        crm_status = order.get('status', {}).get('title', 'Неизвестно')
-        
-        # Получаем дату сканирования (если есть)
-        confirmed_date = order.get('_confirmed_date')
-        date_str = confirmed_date.strftime('%d.%m') if confirmed_date else "?"
-
-        client = order.get('client', {}) or {}
-        client_name = client.get('fullname', 'Без имени')
-        
-        # === ЛОГИКА ТОВАРОВ (НОВАЯ) ===
-        products = order.get('products', [])
-        if products:
-            # Собираем список всех названий
-            titles = [p.get('title', 'Без названия') for p in products]
-            # Объединяем их через перенос строки + иконку
-            # Результат будет: "Товар 1\n📦 Товар 2\n📦 Товар 3"
-            prod_str = "\n📦 ".join(titles)
-        else:
-            prod_str = "Без товара"
-            
-        ttn = order.get('delivery', {}).get('billOfLading') or \
-              order.get('npDelivery', {}).get('billOfLading') or \
-              "-"
-
-        # === ЛОГИКА СТАТУСОВ ===
-        status_info = f"ℹ️ CRM: {crm_status}"
-        
-        if "відправлено" in filter_status.lower() and "відправлено" not in crm_status.lower():
-             status_info = f"⚠️ CRM: {crm_status} (но уехала {date_str})"
-
-        # Формируем блок
-        # Цена приклеится к последнему товару, это нормально выглядит
-        block = (
-            f"**{i}. Заказ #{o_id}** | 👤 {client_name}\n"
-            f"📦 {prod_str} | 💰 {float(order.get('totalPrice', 0))} грн\n"
-            f"🎫 ТТН: `{ttn}`\n"
-            f"{status_info}"
-        )
-        lines.append(block)
+        lines.append(format_order_block(i, order, filter_status))
         lines.append("─ ─ ─ ─ ─")
 
-    return "\n".join(lines)
\ No newline at end of file
+    return "\n".join(lines)
+
+def _money(value):
+    return f"{value:,.0f}".replace(",", " ")
+
+def _pct(change):
+    if change is None:
+        return "—"
+    arrow = "📈" if change >= 0 else "📉"
+    return f"{arrow} {change:+.1f}%"
+
+def format_trends_report(trends):
+    """Отчет по трендам архива отправок (данные - services.analytics.build_trends)."""
+    if not trends:
+        return "📈 В архиве отправок пока нет данных для трендов."
+
+    lines = [
+        "📈 **ТРЕНДЫ ОТПРАВОК (архив)**",
+        f"📅 На {trends['as_of'].strftime('%d.%m.%Y')} | "
+        f"данные с {trends['first_day'].strftime('%d.%m.%Y')} ({trends['days_collected']} дн.)",
+        "──────────────────",
+    ]
+
+    for cmp in trends['comparisons']:
+        cur_from, cur_to, cur_count, cur_sum, cur_days = cmp['current']
+        prev_from, prev_to, prev_count, prev_sum, prev_days = cmp['previous']
+        lines.append(f"**{cmp['label']}**")
+        lines.append(f"  {cur_from.strftime('%d.%m.%y')}–{cur_to.strftime('%d.%m.%y')}: "
+                     f"{cur_count} шт. | {_money(cur_sum)} грн")
+        if prev_days:
+            lines.append(f"  {prev_from.strftime('%d.%m.%y')}–{prev_to.strftime('%d.%m.%y')}: "
+                         f"{prev_count} шт. | {_money(prev_sum)} грн")
+            lines.append(f"  Заказы {_pct(cmp['count_change'])} | Сумма {_pct(cmp['sum_change'])}")
+        else:
+            lines.append("  Прошлый период в архиве не собран")
+
+    lines.append("──────────────────")
+    lines.append("**Скользящее среднее в день**")
+    for window, (count, total) in trends['rolling'].items():
+        if count == count:  # не NaN
+            lines.append(f"  {window} дн.: {count:.1f} шт. | {_money(total)} грн")
+
+    lines.append("**По дням недели (среднее)**")
+    for name, count, total in trends['weekdays']:
+        if count == count:
+            lines.append(f"  {name}: {count:.1f} шт. | {_money(total)} грн")
+
+    if trends['percentiles']:
+        lines.append(f"**Чек за год ({trends['orders_year']} заказов)**")
+        lines.append(f"  Средний: {_money(trends['mean_amount'])} грн")
+        lines.append("  " + " | ".join(
+            f"p{q}: {_money(value)}" for q, value in trends['percentiles'].items()
+        ))
+
+    lines.append("**По месяцам**")
+    for month, count, total, days in trends['months']:
+        lines.append(f"  {month}: {count} шт. | {_money(total)} грн ({days} дн.)")
+
+    return "\n".join(lines)
+
+# Сколько заказов показываем в каждом разделе разбора (None - все)
+EXPLAIN_LIST_LIMIT = 15
+
+def _explain_list(items, limit):
+    shown = items if limit is None else items[:limit]
+    lines = [f"  #{number} — {reason}" for number, reason in shown]
+    if len(items) > len(shown):
+        lines.append(f"  … и еще {len(items) - len(shown)}")
+    return lines
+
+def format_explain_report(result, limit=EXPLAIN_LIST_LIMIT):
+    """Разбор отчета за день по локальным данным (данные - services.report_explain.explain)."""
+    day = result['day'].strftime('%d.%m.%Y')
+    window_from, window_to = result['window']
+    mirror = result['mirror']
+    lines = [
+        f"🕵️ **РАЗБОР: {result['status'].upper()} за {day}**",
+        f"Источник отчета за день: {result['source']}",
+        f"Окно выборки CRM (дата создания): {window_from.strftime('%d.%m')}–{window_to.strftime('%d.%m')}",
+    ]
+    last_sync = mirror.get('last_sync')
+    lines.append(f"Зеркало заказов: синхронизация {last_sync[:16].replace('T', ' ') if last_sync else 'не было'}")
+    first_created = mirror.get('first_created')
+    if not first_created or first_created[:10] > window_from.strftime('%Y-%m-%d'):
+        lines.append("⚠️ Зеркало не покрывает все окно выборки - разбор может быть неполным")
+    lines.append("──────────────────")
+
+    if 'order' in result:
+        if not result['order']:
+            lines.append(f"❌ Заказа #{result['order_number']} нет в зеркале")
+        for order, included, reason in result['order']:
+            lines.append(f"{'✅ В отчете' if included else '❌ Не в отчете'}: #{order['orderNumber']} — {reason}")
+            lines.append(f"  CRM: {order['status']['title'] or '-'} | ТТН: {order['ttn'] or '-'}")
+            lines.append(f"  created {order['createdAt'] or '-'}")
+            lines.append(f"  updated {order['updatedAt'] or '-'}")
+            lines.append(f"  completed {order['completedAt'] or '-'}")
+            if result['saved'] is not None:
+                saved = order['orderNumber'] in result['saved']
+                lines.append(f"  {result['source']}: {'есть' if saved else 'нет'}")
+        return "\n".join(lines)
+
+    matches = [(o['orderNumber'], reason) for o, reason in result['matches']]
+    near = [(o['orderNumber'], reason) for o, reason in result['near']]
+    lines.append(f"✅ **По правилам отчета: {len(matches)} шт.**")
+    lines.extend(_explain_list(matches, limit))
+    lines.append(f"❌ **Почти попали: {len(near)} шт.**")
+    lines.extend(_explain_list(near, limit))
+
+    if result['moved_on']:
+        lines.append("↪️ **Изменены в этот день, но статус уже другой**")
+        lines.extend(f"  {title}: {count} шт." for title, count in result['moved_on'])
+
+    if result['saved'] is not None:
+        lines.append(f"**{result['source']}: {len(result['saved'])} шт.** (отчет берет день оттуда)")
+        if result['only_saved']:
+            lines.append("  Есть в архиве, но не по зеркалу:")
+            lines.extend(_explain_list(result['only_saved'], limit))
+        if result['only_mirror']:
+            lines.append("  По зеркалу, но нет в архиве:")
+            lines.extend(_explain_list([(n, "сохранен раньше, чем данные изменились") for n in result['only_mirror']], limit))
+    return "\n".join(lines)
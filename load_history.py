@@ -1,55 +1,147 @@
 # Файл: load_history.py
+import os
+import json
 import asyncio
 import logging
-from datetime import date, timedelta
-from services.crm_api import SitniksAPI
-from services.db import init_db, save_daily_stats
+import argparse
+from datetime import date, datetime, timedelta
+from services.crm_api import SitniksAPI, slim_order, STATUS_MARGIN_DAYS
+from services.order_store import order_ttn
+from services.db import init_db, save_daily_stats_bulk
+from services.resilience import track_gaps
 
 # Настройка логов
 logging.basicConfig(level=logging.INFO)
 
-# ПЕРИОД ЗАГРУЗКИ
+# ПЕРИОД ЗАГРУЗКИ (по умолчанию, можно переопределить аргументами)
 START_DATE = date(2026, 1, 1)
 END_DATE = date(2026, 1, 12)
 
-async def load_historical_data():
+# Посылку сканируют через несколько дней после создания заказа -
+# поэтому заказы CRM берем с запасом до начала периода
+MARGIN_DAYS = STATUS_MARGIN_DAYS["відправлено"]
+
+CHECKPOINT_FILE = "load_history.checkpoint.json"
+# CRM качаем кусками по N дней (по дате создания), чекпоинт - после каждого куска
+CRAWL_CHUNK_DAYS = int(os.getenv("HISTORY_CHUNK_DAYS", 7))
+
+
+def _load_checkpoint(start, end):
+    """
+    Где остановилась прошлая загрузка этого же периода:
+    (пройденный этап, по какой день включительно уже скачана CRM).
+    """
+    if not os.path.exists(CHECKPOINT_FILE):
+        return None, None
+    with open(CHECKPOINT_FILE) as f:
+        data = json.load(f)
+    if data.get('start') == str(start) and data.get('end') == str(end):
+        crawled_to = data.get('crawled_to')
+        return data.get('stage'), date.fromisoformat(crawled_to) if crawled_to else None
+    return None, None
+
+
+def _save_checkpoint(start, end, stage, crawled_to=None):
+    with open(CHECKPOINT_FILE, 'w') as f:
+        json.dump({'start': str(start), 'end': str(end), 'stage': stage,
+                   'crawled_to': str(crawled_to) if crawled_to else None}, f)
+
+
+async def load_historical_data(start_date=START_DATE, end_date=END_DATE, margin_days=MARGIN_DAYS):
+    """
+    Загрузка истории за один проход:
+    1. Один раз качаем из CRM весь период (+ запас) в локальное зеркало заказов.
+    2. Один раз спрашиваем у НП все ТТН (без дублей, кэш ТТН переживает обрывы).
+    3. Раскладываем заказы по датам отправки и пишем все дни одной транзакцией.
+    После каждого этапа (и каждого куска CRM) пишем чекпоинт, так что прерванную загрузку
+    можно просто перезапустить - она продолжит с места обрыва.
+    """
     print("⏳ Инициализация базы данных...")
     init_db()
-    
+
     crm = SitniksAPI()
-    
-    print(f"🚀 Начинаю загрузку истории с {START_DATE} по {END_DATE}")
+    stage, crawled_to = _load_checkpoint(start_date, end_date)
+    if stage:
+        print(f"♻️ Продолжаю с чекпоинта (этап '{stage}' уже пройден)")
+    elif crawled_to:
+        print(f"♻️ Продолжаю с чекпоинта (заказы CRM уже скачаны по {crawled_to})")
+
+    print(f"🚀 Начинаю загрузку истории с {start_date} по {end_date}")
     print("-" * 40)
 
-    current_date = START_DATE
-    while current_date <= END_DATE:
-        print(f"📅 Обрабатываю дату: {current_date}...")
-        
-        # 1. Запрашиваем "умный" отчет (CRM + API Новой Почты)
-        # Бот сам проверит ключи, найдет реальную дату сканирования
-        orders = await crm.get_report_orders(current_date, current_date, status_filter="Відправлено")
-        
-        if orders:
-            count = len(orders)
-            total_sum = sum(float(o.get('totalPrice', 0)) for o in orders)
-            
-            # Собираем ID для истории
-            ids = [o.get('orderNumber') or o.get('id') for o in orders]
-            
-            # 2. Сохраняем в БД
-            save_daily_stats(current_date, count, total_sum, ids)
-            print(f"   ✅ Записано: {count} шт. | {total_sum:,.2f} грн")
-        else:
-            save_daily_stats(current_date, 0, 0.0, [])
-            print(f"   🤷‍♂️ Отправок не найдено.")
-            
-        print("-" * 40)
+    crawl_from = start_date - timedelta(days=margin_days)
+
+    # 1. CRM: весь период (+ запас) кусками по CRAWL_CHUNK_DAYS дней
+    if stage is None:
+        received = 0
+        chunk_from = crawled_to + timedelta(days=1) if crawled_to else crawl_from
+        while chunk_from <= end_date:
+            chunk_to = min(chunk_from + timedelta(days=CRAWL_CHUNK_DAYS - 1), end_date)
+            async for batch in crm.iter_order_pages(chunk_from, chunk_to):
+                await crm.store.upsert_orders(batch)
+                received += len(batch)
+            # Кусок в зеркале - после обрыва начнем со следующего
+            _save_checkpoint(start_date, end_date, None, chunk_to)
+            chunk_from = chunk_to + timedelta(days=1)
+        print(f"📥 Получено заказов из CRM: {received}")
+        stage = 'crawled'
+        _save_checkpoint(start_date, end_date, stage)
+
+    # Дальше работаем только с "тонкими" записями из зеркала
+    orders_with_ttn = []
+    async for order in crm.store.iter_orders(crawl_from, end_date):
+        ttn = order_ttn(order)
+        if ttn:
+            orders_with_ttn.append((slim_order(order), ttn))
+
+    # 2. НП: все ТТН одним проходом (уже известные берутся из кэша)
+    with track_gaps() as gaps:
+        np_dates = await crm.np_api.get_tracking_dates([ttn for _, ttn in orders_with_ttn])
+    print(f"🚚 Дат отправки от НП: {len(np_dates)} из {len(orders_with_ttn)} ТТН")
+    if gaps:
+        # Дни с дырами в архив не пишем. Ответы НП уже в кэше ТТН - перезапуск доспросит только остаток
+        print(f"❌ Данные НП неполные ({'; '.join(gaps)}). Перезапустите загрузку позже.")
+        return
+    stage = 'tracked'
+    _save_checkpoint(start_date, end_date, stage)
+
+    # 3. Раскладываем по дням
+    buckets = {}
+    for order, ttn in orders_with_ttn:
+        real_date = np_dates.get(ttn)
+        if real_date and start_date <= real_date <= end_date:
+            buckets.setdefault(real_date, []).append(order)
+
+    rows = []
+    current_date = start_date
+    while current_date <= end_date:
+        day_orders = buckets.get(current_date, [])
+        count = len(day_orders)
+        total_sum = sum(float(o.get('totalPrice', 0)) for o in day_orders)
+        rows.append((current_date, day_orders))
+        print(f"📅 {current_date}: {count} шт. | {total_sum:,.2f} грн")
         current_date += timedelta(days=1)
-        
-        # Маленькая пауза, чтобы не дудосить API (хороший тон)
-        await asyncio.sleep(0.5)
 
+    await save_daily_stats_bulk(rows)
+    if os.path.exists(CHECKPOINT_FILE):
+        os.remove(CHECKPOINT_FILE)
+
+    print("-" * 40)
     print("🏁 Историческая загрузка завершена!")
 
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="Загрузка истории отправок в bot_stats.db")
+    parser.add_argument("--start", default=str(START_DATE), help="Начало периода (ГГГГ-ММ-ДД)")
+    parser.add_argument("--end", default=str(END_DATE), help="Конец периода (ГГГГ-ММ-ДД)")
+    parser.add_argument("--margin-days", type=int, default=MARGIN_DAYS,
+                        help="Запас дней до начала периода для заказов CRM")
+    args = parser.parse_args()
+    start = datetime.strptime(args.start, "%Y-%m-%d").date()
+    end = datetime.strptime(args.end, "%Y-%m-%d").date()
+    return start, end, args.margin_days
+
+
 if __name__ == "__main__":
-    asyncio.run(load_historical_data())
\ No newline at end of file
+    start, end, margin = _parse_args()
+    asyncio.run(load_historical_data(start, end, margin))
@@ -1,29 +1,64 @@
 # Файл: main.py
 import asyncio
 import os
+import signal
+import uuid
 import logging
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+from aiogram.filters import Command, CommandObject
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from dotenv import load_dotenv
 from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 # Импорты наших сервисов
-from services.crm_api import SitniksAPI
-from formatter import format_order_report
+from services.crm_api import SitniksAPI, CRMFetchError
+from formatter import (
+    format_report_summary, format_report_page, page_offsets, page_count, format_trends_report,
+    format_explain_report, MESSAGE_LIMIT
+)
 from services.scheduler import setup_scheduler
-from services.db import init_db, get_saved_ids_for_date
+from services.db import init_db, close_db
+from services.report_planner import build_report
+from services.http_client import create_http_session
+from services.report_cache import ReportCache, report_ttl
+from services.report_jobs import ReportJobs, Progress
+from services.metrics import render_metrics, REPORT_SECONDS
+from services import analytics
+from services.report_export import export_report, export_filename
+from services.report_explain import explain
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
 
-bot = Bot(token=os.getenv("BOT_TOKEN"))
+# Режим получения апдейтов: polling (по умолчанию) или webhook на нашем же сервере
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_URL") or os.getenv("RENDER_EXTERNAL_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+if BOT_MODE == "webhook" and not (WEBHOOK_BASE_URL and WEBHOOK_SECRET):
+    logging.warning("⚠️ Для webhook нужны WEBHOOK_URL и WEBHOOK_SECRET - работаю через polling")
+    BOT_MODE = "polling"
+
+# Bot, HTTP-клиент и CRM создаются в main()/по первому запросу, а не при импорте:
+# после холодного старта на Render бот должен ответить как можно быстрее
+bot = None
+http_session = None
+crm = None
 dp = Dispatcher()
-crm = SitniksAPI()
+report_cache = ReportCache()
+report_jobs = ReportJobs()
+# Как часто обновляем сообщение с прогрессом отчета (секунды)
+PROGRESS_INTERVAL = 2
+# Как часто сохраняем снимок кэша отчетов на диск (секунды)
+SNAPSHOT_INTERVAL = int(os.getenv("REPORT_CACHE_SNAPSHOT_SECONDS", 600))
 
 # --- СОСТОЯНИЯ (FSM) ---
 class ReportFlow(StatesGroup):
@@ -35,7 +70,7 @@ class ReportFlow(StatesGroup):
 def get_main_kb():
     return ReplyKeyboardMarkup(keyboard=[
         [KeyboardButton(text="📉 Вчера"), KeyboardButton(text="📅 Конкретная дата")],
-        [KeyboardButton(text="🗓 За период")]
+        [KeyboardButton(text="🗓 За период"), KeyboardButton(text="📈 Тренды")]
     ], resize_keyboard=True)
 
 def get_status_kb():
@@ -47,6 +82,53 @@ def get_status_kb():
         [KeyboardButton(text="Всі"), KeyboardButton(text="🔙 Отмена")]
     ], resize_keyboard=True)
 
+def get_cancel_kb():
+    return ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text="🔙 Отмена")]], resize_keyboard=True)
+
+def get_pages_kb(view_id, page, pages):
+    """Навигация по страницам отчета."""
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton(text="◀️", callback_data=f"rp:{view_id}:{page - 1}"))
+    buttons.append(InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data=f"rp:{view_id}:{page}"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton(text="▶️", callback_data=f"rp:{view_id}:{page + 1}"))
+    # Длинный отчет удобнее выгрузить одним файлом
+    export = [
+        InlineKeyboardButton(text="📄 CSV", callback_data=f"rx:{view_id}:csv"),
+        InlineKeyboardButton(text="📊 XLSX", callback_data=f"rx:{view_id}:xlsx"),
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=[buttons, export])
+
+# --- СТРАНИЧНЫЙ ПРОСМОТР ОТЧЕТОВ ---
+# view_id -> готовый результат отчета; страницы рендерятся из него по запросу
+report_views = OrderedDict()
+REPORT_VIEWS_MAX = 100
+
+async def save_report_view(orders, period_str, status_choice, source_msg):
+    view_id = uuid.uuid4().hex[:12]
+    # Границы страниц считаем один раз (по длине блоков) - в потоке, отчет может быть большим
+    offsets = await asyncio.to_thread(page_offsets, orders, status_choice)
+    report_views[view_id] = (orders, period_str, status_choice, source_msg, offsets)
+    while len(report_views) > REPORT_VIEWS_MAX:
+        report_views.popitem(last=False)
+    return view_id
+
+def render_report_view(view_id, page):
+    """Текст страницы page (с нуля) и общее число страниц. Первая страница - с шапкой."""
+    orders, period_str, status_choice, source_msg, offsets = report_views[view_id]
+    pages = page_count(offsets)
+    page = min(max(page, 0), pages - 1)
+
+    text = format_report_page(orders, page, offsets, filter_status=status_choice)
+    if page == 0:
+        # Добавляем шапку и приписку про источник данных, если есть
+        summary = source_msg + format_report_summary(orders, period_str, filter_status=status_choice)
+        text = summary + "\n" + text if text else summary
+    else:
+        text = f"📄 Страница {page + 1}/{pages} | {status_choice} | {period_str}\n" + text
+    return text, pages
+
 # --- ХЕНДЛЕРЫ ---
 
 @dp.message(Command("start"))
@@ -57,6 +139,10 @@ async def cmd_start(message: types.Message, state: FSMContext):
 @dp.message(F.text == "🔙 Отмена")
 async def global_cancel(message: types.Message, state: FSMContext):
     await state.clear()
+    # Заодно отменяем отчет, который еще считается
+    if report_jobs.cancel(message.from_user.id):
+        await message.answer("Отменено", reply_markup=get_main_kb())
+        return
     await message.answer("🏠 Главное меню", reply_markup=get_main_kb())
 
 @dp.message(F.text == "📉 Вчера")
@@ -101,6 +187,60 @@ async def process_period(message: types.Message, state: FSMContext):
     except ValueError:
         await message.answer("⚠️ Ошибка. Нужен формат 01.01-05.01")
 
+def get_crm():
+    """Клиент CRM создаем при первом отчете (он же заводит таблицы зеркала и кэша ТТН)."""
+    global crm
+    if crm is None:
+        crm = SitniksAPI(session=http_session)
+    return crm
+
+async def build_report_orders(d_start, d_end, status_choice):
+    """Собирает заказы для отчета. Возвращает (orders, source_msg, gaps)."""
+    # === ГИБРИДНАЯ ЛОГИКА (по дням) ===
+    # Сохраненные дни - из архива/сводок, недостающие и сегодня - Live режим
+    return await build_report(get_crm(), d_start, d_end, status_choice)
+
+@dp.message(F.text == "📈 Тренды")
+async def report_trends(message: types.Message, state: FSMContext):
+    await state.clear()
+    # Только архив, без CRM и НП (запросы к БД идут вне event loop, расчеты - миллисекунды)
+    with REPORT_SECONDS.time(status="тренды", source="archive"):
+        trends = await analytics.build_trends()
+    await message.answer(format_trends_report(trends), parse_mode="Markdown", reply_markup=get_main_kb())
+
+@dp.message(Command("cache"))
+async def cmd_cache_stats(message: types.Message):
+    st = report_cache.stats()
+    await message.answer(
+        f"🗃 Кэш отчетов: {st['entries']} шт. (в работе: {st['inflight']})\n"
+        f"✅ Попаданий: {st['hits']} | 🔗 Склеено: {st['coalesced']} | ❌ Промахов: {st['misses']}\n"
+        f"📈 Hit rate: {st['hit_rate']}%"
+    )
+
+@dp.message(Command("explain"))
+async def cmd_explain(message: types.Message, command: CommandObject):
+    """
+    /explain 10.01 ТТН сформовано [#12345] - почему заказы попали или не попали в отчет.
+    Только локальные данные (зеркало заказов, кэш ТТН, архив) - CRM и НП не трогаем.
+    """
+    parts = (command.args or "").split()
+    order_number = parts.pop()[1:] if len(parts) > 2 and parts[-1].startswith("#") else None
+    try:
+        date_str = parts[0] if parts[0].count(".") == 2 else f"{parts[0]}.{datetime.now().year}"
+        target_date = datetime.strptime(date_str, "%d.%m.%Y").date()
+        status = " ".join(parts[1:])
+    except (IndexError, ValueError):
+        status = ""
+    if not status:
+        await message.answer("⚠️ Формат: /explain 10.01 ТТН сформовано (можно добавить #номер заказа)")
+        return
+
+    result = await explain(get_crm(), target_date, status, order_number=order_number)
+    text = format_explain_report(result)
+    if len(text) > MESSAGE_LIMIT:
+        text = text[:MESSAGE_LIMIT] + "\n…"
+    await message.answer(text, parse_mode="Markdown")
+
 @dp.message(ReportFlow.waiting_for_status)
 async def generate_final_report(message: types.Message, state: FSMContext):
     status_choice = message.text.strip()
@@ -114,99 +254,220 @@ async def generate_final_report(message: types.Message, state: FSMContext):
     d_start = data['date_start']
     d_end = data['date_end']
     
-    loading_msg = await message.answer(f"⏳ Формирую отчет '{status_choice}'...", reply_markup=types.ReplyKeyboardRemove())
-    
-    orders = []
-    source_msg = ""
-    
-    # === ГИБРИДНАЯ ЛОГИКА ===
-    # Если запрашиваем один день И статус "Відправлено" - пробуем взять из базы
-    if d_start == d_end and "відправлено" in status_choice.lower():
-        # 1. Проверяем БД
-        saved_ids = get_saved_ids_for_date(d_start)
-        
-        if saved_ids:
-            # ДАННЫЕ ЕСТЬ В БАЗЕ -> Режим "Библиотекарь"
-            orders = await crm.get_orders_by_specific_ids(d_start, saved_ids)
-            source_msg = "💾 *Данные взяты из архива (БД)*\n"
-        else:
-            # ДАННЫХ НЕТ -> Режим "Разведчик"
-            orders = await crm.get_report_orders(d_start, d_end, status_filter=status_choice)
-    else:
-        # Для периодов или других статусов - всегда Live режим
-        orders = await crm.get_report_orders(d_start, d_end, status_filter=status_choice)
+    loading_msg = await message.answer(f"⏳ Формирую отчет '{status_choice}'...", reply_markup=get_cancel_kb())
+    await state.clear()
+
+    # Отчет считается в фоне: пользователь может отменить его или запросить новый
+    progress = Progress()
+    report_jobs.start(
+        message.from_user.id,
+        run_report_job(message, loading_msg, progress, d_start, d_end, status_choice),
+        progress
+    )
+
+async def show_progress(loading_msg, progress, status_choice):
+    """Раз в пару секунд обновляет сообщение "Формирую отчет" живым прогрессом."""
+    last_text = ""
+    while True:
+        await asyncio.sleep(PROGRESS_INTERVAL)
+        text = f"⏳ Формирую отчет '{status_choice}'...\n{progress.text()}"
+        if text != last_text:
+            try:
+                await loading_msg.edit_text(text)
+            except TelegramBadRequest:
+                pass
+            last_text = text
+
+async def run_report_job(message, loading_msg, progress, d_start, d_end, status_choice):
+    updater = asyncio.create_task(show_progress(loading_msg, progress, status_choice))
+    try:
+        # Одинаковые отчеты (тот же период и статус) считаем один раз на всех
+        key = report_cache.make_key(d_start, d_end, status_choice)
+        orders, source_msg, gaps = await report_cache.get_or_compute(
+            key,
+            lambda: build_report_orders(d_start, d_end, status_choice),
+            ttl=report_ttl(d_end)
+        )
+        if gaps:
+            # Неполный отчет не кэшируем - следующий запрос попробует заново
+            report_cache.discard(key)
+    except CRMFetchError as e:
+        logging.error(f"Отчет не собран: {e}")
+        await loading_msg.edit_text("⚠️ CRM не отвечает, отчет был бы неполным. Попробуйте позже.")
+        await message.answer("🏠 Главное меню", reply_markup=get_main_kb())
+        return
+    except asyncio.CancelledError:
+        try:
+            await loading_msg.edit_text(f"❌ Отчет '{status_choice}' отменен")
+        except TelegramBadRequest:
+            pass
+        raise
+    finally:
+        updater.cancel()
+    report_cache.log_stats()
     
     # --- ФОРМАТИРОВАНИЕ ---
+    # Сразу форматируем только шапку и первую страницу, остальные - по кнопкам
     period_str = f"{d_start}" if d_start == d_end else f"{d_start}-{d_end}"
-    text = format_order_report(orders, period_str, filter_status=status_choice)
-    
-    # Добавляем приписку про архив, если есть
-    if source_msg:
-        text = source_msg + text
+    view_id = await save_report_view(orders, period_str, status_choice, source_msg)
 
     try:
         await loading_msg.delete()
     except:
         pass
 
-    # === УМНАЯ РАЗБИВКА СООБЩЕНИЙ (Smart Split) ===
-    # Разбиваем текст СТРОГО ПО СТРОКАМ, чтобы не резать жирный шрифт
-    if len(text) > 4000:
-        chunks = []
-        current_chunk = ""
-        
-        for line in text.split('\n'):
-            # Проверяем, влезет ли новая строка в текущий чанк
-            # +1 это символ переноса строки, который съедается при split
-            if len(current_chunk) + len(line) + 1 > 4000:
-                chunks.append(current_chunk)
-                current_chunk = ""
-            
-            current_chunk += line + "\n"
-        
-        # Не забываем последний кусок
-        if current_chunk:
-            chunks.append(current_chunk)
-            
-        # Отправляем куски по очереди
-        for i, chunk in enumerate(chunks):
-            # Клавиатуру добавляем только к самому последнему сообщению
-            if i == len(chunks) - 1:
-                await message.answer(chunk, parse_mode="Markdown", reply_markup=get_main_kb())
-            else:
-                await message.answer(chunk, parse_mode="Markdown")
-    else:
-        # Если сообщение короткое, отправляем как есть
+    text, pages = render_report_view(view_id, 0)
+    if pages == 1:
+        # Короткий отчет - одно сообщение, как раньше
         await message.answer(text, parse_mode="Markdown", reply_markup=get_main_kb())
-        
-    await state.clear()
+    else:
+        await message.answer(text, parse_mode="Markdown", reply_markup=get_pages_kb(view_id, 0, pages))
+        await message.answer("🏠 Главное меню", reply_markup=get_main_kb())
+
+@dp.callback_query(F.data.startswith("rp:"))
+async def report_page(callback: types.CallbackQuery):
+    _, view_id, page = callback.data.split(":")
+    page = int(page)
+    if view_id not in report_views:
+        await callback.answer("⌛ Отчет устарел, сформируйте его заново", show_alert=True)
+        return
+
+    text, pages = render_report_view(view_id, page)
+    try:
+        await callback.message.edit_text(text, parse_mode="Markdown",
+                                         reply_markup=get_pages_kb(view_id, page, pages))
+    except TelegramBadRequest:
+        pass # "message is not modified" - нажали на текущую страницу
+    await callback.answer()
+
+@dp.callback_query(F.data.startswith("rx:"))
+async def report_export(callback: types.CallbackQuery):
+    _, view_id, fmt = callback.data.split(":")
+    if view_id not in report_views:
+        await callback.answer("⌛ Отчет устарел, сформируйте его заново", show_alert=True)
+        return
+
+    orders, period_str, status_choice, _, _ = report_views[view_id]
+    await callback.answer(f"⏳ Готовлю {fmt.upper()}...")
+    # Файл пишется построчно в потоке, одно сообщение-документ вместо десятков страниц
+    path = await asyncio.to_thread(export_report, orders, fmt, f"{status_choice} {period_str}")
+    try:
+        await callback.message.answer_document(
+            FSInputFile(path, filename=export_filename(status_choice, period_str, fmt)),
+            caption=f"📎 {status_choice} | {period_str} | {len(orders)} заказов"
+        )
+    finally:
+        os.remove(path)
 
 # --- ВЕБ-СЕРВЕР (Для Render) ---
 async def keep_alive(request):
     return web.Response(text="I am alive")
 
+async def metrics_endpoint(request):
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
 async def start_server():
+    """
+    Один aiohttp-сервер на $PORT: keep-alive для Render
+    и (в режиме webhook) прием апдейтов Telegram.
+    """
     app = web.Application()
-    app.add_routes([web.get('/', keep_alive)])
+    app.add_routes([web.get('/', keep_alive), web.get('/metrics', metrics_endpoint)])
+
+    if BOT_MODE == "webhook":
+        # Апдейты без секретного токена в заголовке отбрасываются (401)
+        SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
+
     runner = web.AppRunner(app)
     await runner.setup()
     port = int(os.environ.get("PORT", 8080))
     site = web.TCPSite(runner, "0.0.0.0", port)
     await site.start()
+    return runner
+
+async def run_webhook():
+    """
+    Регистрирует webhook в Telegram и ждет SIGTERM/SIGINT - апдейты приходят на наш сервер.
+    В отличие от start_polling, сам по себе webhook сигналы не ловит: без обработчика
+    процесс умер бы, не дойдя до finally в main() (снимок кэша, закрытие сервера и БД).
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    await bot.set_webhook(
+        f"{WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    logging.info(f"🌐 Режим webhook: {WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}")
+    try:
+        await stop.wait()
+        logging.info("🛑 Получен сигнал остановки")
+    finally:
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(sig)
+
+async def run_polling():
+    # Если раньше работали через webhook - снимаем его, иначе polling не получит апдейты
+    await bot.delete_webhook(drop_pending_updates=False)
+    logging.info("🔁 Режим polling")
+    await dp.start_polling(bot)
+
+async def snapshot_loop():
+    """Поднимает кэш отчетов из снимка (уже после старта бота) и периодически его сохраняет."""
+    restored = report_cache.load_snapshot()
+    if restored:
+        logging.info(f"♻️ Из снимка поднято отчетов: {restored}")
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        try:
+            report_cache.save_snapshot()
+        except OSError as e:
+            logging.warning(f"Снимок кэша отчетов не сохранен: {e}")
 
 # --- ЗАПУСК ---
 async def main():
-    # 1. Инициализация БД
-    init_db()
-    
-    # 2. Запуск сервера
-    await start_server()
-    
-    # 3. Запуск планировщика (сбор данных в 23:50)
-    setup_scheduler(bot)
-    
-    # 4. Запуск бота
-    await dp.start_polling(bot)
+    global bot, http_session
+
+    bot = Bot(token=os.getenv("BOT_TOKEN"))
+    # 1. Общий HTTP-клиент (пул соединений для CRM и НП)
+    http_session = create_http_session()
+
+    runner = None
+    snapshots = None
+    try:
+        # 2. Сначала сервер: Render видит открытый порт сразу после старта
+        runner = await start_server()
+
+        # 3. Инициализация БД
+        init_db()
+
+        # 4. Кэш отчетов с прошлого запуска - в фоне
+        snapshots = asyncio.create_task(snapshot_loop())
+
+        # 5. Запуск планировщика (сбор данных в течение дня и в 23:50, догрузка пропусков)
+        setup_scheduler(bot, get_crm, on_archive_change=report_cache.invalidate)
+
+        # 6. Запуск бота
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await run_polling()
+    finally:
+        if snapshots:
+            snapshots.cancel()
+            # Render гасит инстанс через SIGTERM - сохраняем, что успели посчитать
+            try:
+                report_cache.save_snapshot()
+            except OSError as e:
+                logging.warning(f"Снимок кэша отчетов не сохранен: {e}")
+        if runner:
+            await runner.cleanup()
+        await http_session.close()
+        await bot.session.close()
+        close_db()
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
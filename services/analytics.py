@@ -0,0 +1,175 @@
+# Файл: services/analytics.py
+"""
+Аналитика трендов по архиву отправок (shipments).
+
+Архив грузится один раз в колонки NumPy на сплошной оси дней:
+несобранные дни - NaN, дни без отправок - 0. Все расчеты (скользящие
+средние, профиль по дням недели, сравнение периодов, помесячные итоги,
+перцентили чека) - векторные, без циклов по дням, поэтому несколько лет
+архива считаются за миллисекунды.
+"""
+import os
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from .db import get_stats_for_period, get_shipment_amounts
+
+# Сколько истории грузим для трендов (дней): год к году + запас
+HISTORY_DAYS = int(os.getenv("TRENDS_HISTORY_DAYS", 800))
+PERCENTILES = (50, 90, 99)
+WEEKDAYS = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+
+
+class DailySeries:
+    """Колонки архива: days (datetime64[D]), counts и sums (float, NaN - день не собран)."""
+
+    def __init__(self, start, days, counts, sums):
+        self.start = start
+        self.days = days
+        self.counts = counts
+        self.sums = sums
+
+    @classmethod
+    async def load(cls, date_start, date_end):
+        size = (date_end - date_start).days + 1
+        days = np.arange(np.datetime64(date_start, 'D'), np.datetime64(date_end, 'D') + 1)
+        counts = np.full(size, np.nan)
+        sums = np.full(size, np.nan)
+
+        rows = await get_stats_for_period(date_start, date_end)
+        if rows:
+            dates, day_counts, day_sums = zip(*rows)
+            idx = (np.array(dates, dtype='datetime64[D]') - days[0]).astype(np.int64)
+            counts[idx] = day_counts
+            sums[idx] = day_sums
+        return cls(date_start, days, counts, sums)
+
+    def index(self, date_obj):
+        return (date_obj - self.start).days
+
+    @property
+    def collected(self):
+        return ~np.isnan(self.counts)
+
+    def window(self, date_start, date_end):
+        """(дней собрано, заказов, сумма) за период, по срезу без поиска."""
+        lo = max(self.index(date_start), 0)
+        hi = min(self.index(date_end) + 1, len(self.days))
+        if hi <= lo:
+            return 0, 0, 0.0
+        counts = self.counts[lo:hi]
+        return int(np.count_nonzero(~np.isnan(counts))), int(np.nansum(counts)), float(np.nansum(self.sums[lo:hi]))
+
+
+def rolling_mean(values, window):
+    """Скользящее среднее по собранным дням (NaN не тянут среднее к нулю)."""
+    valid = ~np.isnan(values)
+    csum = np.concatenate(([0.0], np.cumsum(np.where(valid, values, 0.0))))
+    cnt = np.concatenate(([0], np.cumsum(valid)))
+    sums = csum[window:] - csum[:-window]
+    counts = cnt[window:] - cnt[:-window]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+    # Первые window-1 дней - неполное окно
+    return np.concatenate((np.full(window - 1, np.nan), means))
+
+
+def weekday_profile(series):
+    """Среднее число заказов и сумма по дням недели (Пн=0), только по собранным дням."""
+    valid = series.collected
+    # 1970-01-01 (день 0) - четверг
+    weekday = (series.days.astype(np.int64) + 3) % 7
+    n = np.bincount(weekday[valid], minlength=7)
+    counts = np.bincount(weekday[valid], weights=series.counts[valid], minlength=7)
+    sums = np.bincount(weekday[valid], weights=series.sums[valid], minlength=7)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return counts / n, sums / n
+
+
+def monthly_totals(series, months=12):
+    """Итоги последних months месяцев: [(YYYY-MM, заказов, сумма, дней собрано)]."""
+    month_ids = series.days.astype('datetime64[M]')
+    starts = np.flatnonzero(np.concatenate(([True], month_ids[1:] != month_ids[:-1])))
+    counts = np.add.reduceat(np.nan_to_num(series.counts), starts)
+    sums = np.add.reduceat(np.nan_to_num(series.sums), starts)
+    collected = np.add.reduceat(series.collected.astype(np.int64), starts)
+    rows = [
+        (str(month_ids[s]), int(c), float(t), int(d))
+        for s, c, t, d in zip(starts, counts, sums, collected)
+    ]
+    return [r for r in rows if r[3]][-months:]
+
+
+def percentiles(amounts, q=PERCENTILES):
+    if not len(amounts):
+        return {}
+    return dict(zip(q, np.percentile(amounts, q).tolist()))
+
+
+def _shift_year(date_obj, years):
+    try:
+        return date_obj.replace(year=date_obj.year + years)
+    except ValueError:  # 29 февраля
+        return date_obj.replace(year=date_obj.year + years, day=28)
+
+
+def _change(current, previous):
+    return (current - previous) / previous * 100 if previous else None
+
+
+def _compare(series, label, cur, prev):
+    cur_days, cur_count, cur_sum = series.window(*cur)
+    prev_days, prev_count, prev_sum = series.window(*prev)
+    return {
+        'label': label,
+        'current': (cur[0], cur[1], cur_count, cur_sum, cur_days),
+        'previous': (prev[0], prev[1], prev_count, prev_sum, prev_days),
+        'count_change': _change(cur_count, prev_count),
+        'sum_change': _change(cur_sum, prev_sum),
+    }
+
+
+async def build_trends(as_of=None, history_days=HISTORY_DAYS):
+    """
+    Тренды по архиву на дату as_of (по умолчанию вчера - сегодня еще не собран).
+    Возвращает dict для formatter.format_trends_report или None, если архив пуст.
+    """
+    as_of = as_of or (datetime.now() - timedelta(days=1)).date()
+    series = await DailySeries.load(as_of - timedelta(days=history_days), as_of)
+    if not series.collected.any():
+        return None
+
+    month_start = as_of.replace(day=1)
+    prev_month_end = month_start - timedelta(days=1)
+    prev_month_start = prev_month_end.replace(day=1)
+    # Месяц к месяцу - одинаковое число дней от начала месяца
+    prev_mtd_end = min(prev_month_start + (as_of - month_start), prev_month_end)
+
+    comparisons = [
+        _compare(series, "Месяц к месяцу", (month_start, as_of), (prev_month_start, prev_mtd_end)),
+        _compare(series, "Год к году", (month_start, as_of),
+                 (_shift_year(month_start, -1), _shift_year(as_of, -1))),
+        _compare(series, "30 дней к 30 дням", (as_of - timedelta(days=29), as_of),
+                 (as_of - timedelta(days=59), as_of - timedelta(days=30))),
+    ]
+
+    collected_idx = np.flatnonzero(series.collected)
+    weekday_counts, weekday_sums = weekday_profile(series)
+    # Перцентили чека - по заказам последнего года
+    amounts = np.fromiter(await get_shipment_amounts(as_of - timedelta(days=364), as_of), dtype=float)
+    return {
+        'as_of': as_of,
+        'first_day': series.days[collected_idx[0]].astype(date),
+        'days_collected': len(collected_idx),
+        'rolling': {
+            window: (rolling_mean(series.counts, window)[-1], rolling_mean(series.sums, window)[-1])
+            for window in (7, 30)
+        },
+        'comparisons': comparisons,
+        'weekdays': list(zip(WEEKDAYS, weekday_counts.tolist(), weekday_sums.tolist())),
+        'months': monthly_totals(series),
+        'orders_year': len(amounts),
+        'mean_amount': float(amounts.mean()) if len(amounts) else 0.0,
+        'percentiles': percentiles(amounts),
+    }
@@ -0,0 +1,118 @@
+# Файл: services/async_db.py
+import os
+import asyncio
+import sqlite3
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Сколько потоков-читателей (у каждого свое постоянное соединение)
+READERS = int(os.getenv("DB_READERS", 2))
+# Кэш скомпилированных запросов на соединение (sqlite3 переиспользует prepared statements)
+STATEMENT_CACHE = 256
+
+
+class AsyncDB:
+    """
+    Доступ к SQLite без блокировки event loop.
+    - Соединения постоянные (по одному на поток), журнал WAL: читатели не ждут писателя.
+    - Чтения идут в пуле из READERS потоков.
+    - Запись - в одном потоке-писателе. Все записи, накопившиеся пока писатель был занят,
+      выполняются одной транзакцией (group commit), каждая в своем SAVEPOINT:
+      ошибка одной записи не откатывает соседние.
+    Функции запросов получают курсор первым аргументом: func(c, *args).
+    """
+
+    def __init__(self, db_name, readers=READERS):
+        self.db_name = db_name
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-read")
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._pending = []  # (func, args, future, loop)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # isolation_level=None - транзакциями управляем сами (BEGIN/COMMIT в писателе)
+            conn = sqlite3.connect(self.db_name, timeout=30, isolation_level=None,
+                                   check_same_thread=False, cached_statements=STATEMENT_CACHE)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    # --- ЧТЕНИЕ ---
+
+    async def read(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, self._run_read, func, args)
+
+    def _run_read(self, func, args):
+        return func(self._connection().cursor(), *args)
+
+    # --- ЗАПИСЬ ---
+
+    async def write(self, func, *args):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            self._pending.append((func, args, future, loop))
+            first = len(self._pending) == 1
+        if first:
+            # Писатель заберет все, что накопится к его запуску
+            self._writer.submit(self._flush)
+        return await future
+
+    def _flush(self):
+        with self._lock:
+            jobs, self._pending = self._pending, []
+        if not jobs:
+            return
+        conn = self._connection()
+        c = conn.cursor()
+        outcomes = []
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            for func, args, future, loop in jobs:
+                c.execute("SAVEPOINT job")
+                try:
+                    outcomes.append((future, loop, func(c, *args), None))
+                    c.execute("RELEASE job")
+                except Exception as e:
+                    c.execute("ROLLBACK TO job")
+                    c.execute("RELEASE job")
+                    outcomes.append((future, loop, None, e))
+            c.execute("COMMIT")
+        except Exception as e:
+            logging.error(f"Пакет записей в БД ({len(jobs)} шт.) не записан: {e!r}")
+            if conn.in_transaction:
+                c.execute("ROLLBACK")
+            outcomes = [(future, loop, None, e) for _, _, future, loop in jobs]
+        if len(jobs) > 1:
+            logging.debug(f"💾 Group commit: {len(jobs)} записей одной транзакцией")
+        for future, loop, result, error in outcomes:
+            loop.call_soon_threadsafe(_resolve, future, result, error)
+
+    # --- ЗАКРЫТИЕ ---
+
+    def close(self):
+        """Дожидается записей и закрывает соединения (при остановке бота)."""
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+
+def _resolve(future, result, error):
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
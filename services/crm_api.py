@@ -1,86 +1,269 @@
 # Файл: services/crm_api.py
 import os
-import aiohttp
+import time
+import asyncio
 import logging
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from .novaposhta_api import NovaPoshtaAPI
+from .order_store import OrderStore, order_ttn
+from .http_client import session_scope
+from .report_jobs import track
+from .metrics import CRM_PAGE_SECONDS, CRM_HTTP_ERRORS, ORDERS_PROCESSED
+from .resilience import (
+    AdaptiveLimit, get_breaker, backoff_delay, retry_after, is_throttle, RETRYABLE_STATUSES
+)
 
 load_dotenv()
 
+PAGE_LIMIT = 50
+# Сколько страниц CRM качаем одновременно
+PAGE_CONCURRENCY = int(os.getenv("CRM_PAGE_CONCURRENCY", 4))
+PAGE_RETRIES = int(os.getenv("CRM_PAGE_RETRIES", 5))
+# Общие на процесс: размер волны страниц (AIMD) и breaker эндпоинта /orders
+CRM_LIMIT = AdaptiveLimit(PAGE_CONCURRENCY)
+CRM_BREAKER = get_breaker("crm")
+
+# Запас дней ДО начала периода, за который берем заказы CRM (по дате создания):
+# - отправка: НП сканирует посылку через несколько дней после создания заказа
+# - виконано: заказ закрывают после доставки/оплаты, это дольше
+# - остальные статусы: дата события = updatedAt, но заказ мог быть создан раньше
+STATUS_MARGIN_DAYS = {
+    "відправлено": int(os.getenv("CRM_MARGIN_SHIPPED", 14)),
+    "виконано": int(os.getenv("CRM_MARGIN_COMPLETED", 30)),
+}
+DEFAULT_MARGIN_DAYS = int(os.getenv("CRM_MARGIN_DEFAULT", 30))
+
+# Статусы из меню бота (по ним же строятся дневные сводки)
+REPORT_STATUSES = [
+    "Перевірити обмін", "Очікує обмін", "Обмін підтверджено", "Виконано",
+    "Відмінено", "ТТН сформовано", "Запаковано", "Відправлено", "Всі",
+]
+
+
+class CRMFetchError(Exception):
+    """CRM так и не отдала страницу - отчет был бы неполным."""
+
+def slim_order(order):
+    """
+    "Тонкая" копия заказа - только поля, которые нужны format_order_report.
+    Полные заказы (клиент, доставка, товары со всеми атрибутами) в памяти не держим.
+    """
+    client = order.get('client') or {}
+    return {
+        'id': order.get('id'),
+        'orderNumber': order.get('orderNumber'),
+        'status': {'title': (order.get('status') or {}).get('title', '')},
+        'client': {'fullname': client.get('fullname', 'Без имени')},
+        'products': [{'title': p.get('title', 'Без названия')} for p in (order.get('products') or [])],
+        'totalPrice': order.get('totalPrice', 0),
+        'delivery': {'billOfLading': order_ttn(order)},
+        'createdAt': order.get('createdAt'),
+        'updatedAt': order.get('updatedAt'),
+        'completedAt': order.get('completedAt'),
+    }
+
+
 class SitniksAPI:
-    def __init__(self):
+    def __init__(self, session=None):
+        self.session = session
         self.base_url = os.getenv("CRM_URL", "").rstrip('/')
         self.token = os.getenv("CRM_TOKEN")
         self.headers = {
             "Authorization": f"Bearer {self.token}",
             "Accept": "application/json"
         }
-        self.np_api = NovaPoshtaAPI()
-
-    async def _get_all_orders_in_range(self, days_back=60):
-        """Скачивает заказы с запасом."""
-        date_to = datetime.now()
-        date_from = date_to - timedelta(days=days_back)
-        orders = []
-        limit = 50
-        skip = 0
-        
-        async with aiohttp.ClientSession() as session:
-            while True:
-                params = {
-                    'limit': limit,
-                    'skip': skip,
-                    'dateFrom': date_from.strftime('%Y-%m-%d'),
-                    'dateTo': date_to.strftime('%Y-%m-%d')
-                }
-                url = f"{self.base_url}/orders"
-                try:
-                    async with session.get(url, headers=self.headers, params=params) as resp:
-                        if resp.status != 200:
-                            logging.error(f"API Error {resp.status}: {await resp.text()}")
-                            break
+        self.np_api = NovaPoshtaAPI(session=session)
+        self.store = OrderStore()
+
+    async def _fetch_page(self, session, params, skip):
+        """
+        Одна страница заказов. Сбойную страницу повторяем (пауза с разбросом или Retry-After),
+        а не обрываем весь список. Троттлинг уменьшает волну страниц, серия отказов открывает breaker.
+        """
+        url = f"{self.base_url}/orders"
+        page_params = dict(params, limit=PAGE_LIMIT, skip=skip)
+        last_error = None
+        for attempt in range(1, PAGE_RETRIES + 1):
+            if not CRM_BREAKER.allow():
+                raise CRMFetchError(f"CRM временно недоступна (breaker открыт): {last_error or 'серия ошибок'}")
+            started = time.perf_counter()
+            delay = None
+            try:
+                async with session.get(url, headers=self.headers, params=page_params) as resp:
+                    if resp.status == 200:
                         data = await resp.json()
-                        batch = data.get('data', [])
-                        if not batch: break
-                        orders.extend(batch)
-                        if len(batch) < limit: break
-                        skip += limit
-                except Exception as e:
-                    logging.error(f"Connection error: {e}")
-                    break
-        return orders
+                        CRM_PAGE_SECONDS.observe(time.perf_counter() - started, outcome="ok")
+                        CRM_BREAKER.record_success()
+                        CRM_LIMIT.on_success()
+                        track('pages')
+                        return data
+                    last_error = f"HTTP {resp.status}: {await resp.text()}"
+                    CRM_HTTP_ERRORS.inc(reason=str(resp.status))
+                    if resp.status not in RETRYABLE_STATUSES:
+                        # 401/404 и т.п. - повтор не поможет
+                        CRM_PAGE_SECONDS.observe(time.perf_counter() - started, outcome="error")
+                        raise CRMFetchError(f"CRM отклонила запрос skip={skip}: {last_error}")
+                    if is_throttle(resp.status, resp.headers):
+                        CRM_LIMIT.on_throttle()
+                        delay = retry_after(resp.headers)
+                    else:
+                        CRM_BREAKER.record_failure()
+            except CRMFetchError:
+                raise
+            except Exception as e:
+                last_error = f"Connection error: {e}"
+                CRM_HTTP_ERRORS.inc(reason=type(e).__name__)
+                CRM_BREAKER.record_failure()
+            CRM_PAGE_SECONDS.observe(time.perf_counter() - started, outcome="error")
+            if attempt == PAGE_RETRIES:
+                break
+            if delay is None:
+                delay = backoff_delay(attempt)
+            logging.warning(f"CRM страница skip={skip}, попытка {attempt}/{PAGE_RETRIES}: {last_error}. "
+                            f"Повтор через {delay:.1f} c")
+            await asyncio.sleep(delay)
+        raise CRMFetchError(f"Не удалось скачать страницу skip={skip}: {last_error}")
+
+    async def _iter_pages(self, params):
+        """
+        Общий пагинатор (async-генератор страниц).
+        Первая страница говорит, сколько всего заказов (если CRM отдает total),
+        остальные качаем волнами до PAGE_CONCURRENCY страниц параллельно
+        (под троттлингом волна сжимается, см. CRM_LIMIT).
+        Страницы отдаются строго по порядку, в памяти не больше одной волны.
+        """
+        async with session_scope(self.session) as session:
+            first = await self._fetch_page(session, params, 0)
+            batch = first.get('data', [])
+            if batch:
+                yield batch
+            if len(batch) < PAGE_LIMIT:
+                return
+
+            total = first.get('total') or (first.get('meta') or {}).get('total')
+            skip = PAGE_LIMIT
+            while not total or skip < int(total):
+                wave = [skip + i * PAGE_LIMIT for i in range(CRM_LIMIT.current())]
+                if total:
+                    wave = [s for s in wave if s < int(total)]
+                pages = await self._fetch_wave(session, params, wave)
+                for page in pages:
+                    batch = page.get('data', [])
+                    if batch:
+                        yield batch
+                    if len(batch) < PAGE_LIMIT:
+                        return
+                skip = wave[-1] + PAGE_LIMIT
+
+    async def _fetch_wave(self, session, params, wave):
+        """
+        Волна страниц параллельно. Если одна страница не скачалась - остальные отменяем:
+        отчет все равно неполный, а соседи иначе продолжали бы повторы с паузами
+        (и упирались бы в уже закрытую временную сессию).
+        """
+        tasks = [asyncio.create_task(self._fetch_page(session, params, s)) for s in wave]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    def _range_params(self, date_from, date_to):
+        return {
+            'dateFrom': date_from.strftime('%Y-%m-%d'),
+            'dateTo': date_to.strftime('%Y-%m-%d')
+        }
+
+    def iter_order_pages(self, date_from, date_to):
+        """Страницы заказов CRM за диапазон дат (для потоковой обработки)."""
+        return self._iter_pages(self._range_params(date_from, date_to))
+
+    def fetch_window(self, date_start, date_end, status_filter=None):
+        """
+        Какие заказы CRM (по дате создания) нужны для отчета за date_start..date_end.
+        Заказ не может сменить статус раньше, чем его создали, поэтому правая граница - date_end.
+        """
+        status = (status_filter or "").lower()
+        margin = DEFAULT_MARGIN_DAYS
+        for key, days in STATUS_MARGIN_DAYS.items():
+            if key in status:
+                margin = days
+                break
+        return date_start - timedelta(days=margin), date_end
+
+    async def sync_orders(self, date_from, date_to=None):
+        """Проходит окно CRM date_from..date_to (по дате создания) в локальное зеркало заказов."""
+        return await self.store.sync(self.iter_order_pages, date_from, date_to)
+
+    async def iter_orders(self, date_from, date_to, sync=True):
+        """
+        Потоковый источник заказов за окно date_from..date_to (по дате создания).
+        Окно сначала проходим в CRM целиком (в зеркало пишутся только изменения),
+        затем читаем из зеркала порциями - все окно в памяти не держим.
+        sync=False - окно уже синхронизировано вызывающим (sync_orders), читаем только зеркало.
+        """
+        if sync:
+            await self.sync_orders(date_from, date_to)
+        async for order in self.store.iter_orders(date_from, date_to):
+            yield order
+
+    def match_event(self, order, target_status):
+        """
+        Дата события заказа для статуса (кроме "Відправлено" - там дата из НП).
+        Возвращает (дата, описание события) или None, если заказ не подходит по статусу.
+        """
+        # ЛОГИКА "ВИКОНАНО"
+        if target_status and "виконано" in target_status:
+            dt_str = order.get('completedAt')
+            if not dt_str and "виконано" in order.get('status', {}).get('title', '').lower():
+                dt_str = order.get('updatedAt')
+            if not dt_str:
+                return None
+            return datetime.fromisoformat(dt_str.replace('Z', '')).date(), "Закриття угоди"
+
+        # ОСТАЛЬНЫЕ СТАТУСЫ
+        current_status = order.get('status', {}).get('title', '').lower()
+        if target_status and target_status not in current_status:
+            return None
+
+        dt_str = order.get('updatedAt') or order.get('createdAt')
+        return datetime.fromisoformat(dt_str.replace('Z', '')).date(), "Зміна статусу"
 
     # === РЕЖИМ 1: РАЗВЕДЧИК (LIVE) ===
     # Используется для текущего дня или если данных нет в базе.
     # Делает запросы к Новой Почте.
-    async def get_report_orders(self, target_date_start, target_date_end=None, status_filter=None):
-        raw_orders = await self._get_all_orders_in_range(days_back=60)
+    async def get_report_orders(self, target_date_start, target_date_end=None, status_filter=None, sync=True):
         filtered_orders = []
         
         if not target_date_end:
             target_date_end = target_date_start
 
+        # Качаем только то окно, которое нужно запросу
+        window_from, window_to = self.fetch_window(target_date_start, target_date_end, status_filter)
+        scanned = 0
+
         target_status = status_filter.lower() if status_filter else None
+        if target_status == "всі":
+            target_status = None # "Всі" = без фильтра по статусу
         
         # 1. ЛОГИКА "ВІДПРАВЛЕНО" (Через НП)
         if target_status and "відправлено" in target_status:
-            # Собираем ТТН
+            # Собираем ТТН (в памяти держим только "тонкие" записи)
             orders_with_ttn = []
-            ttn_list = []
             
-            for order in raw_orders:
-                ttn = order.get('delivery', {}).get('billOfLading')
-                if not ttn:
-                    ttn = order.get('npDelivery', {}).get('billOfLading')
-                
+            async for order in self.iter_orders(window_from, window_to, sync):
+                track('orders')
+                scanned += 1
+                ttn = order_ttn(order)
                 if ttn:
-                    orders_with_ttn.append((order, ttn))
-                    ttn_list.append(ttn)
+                    orders_with_ttn.append((slim_order(order), ttn))
             
             # Запрашиваем даты у НП
-            if ttn_list:
-                np_dates = await self.np_api.get_tracking_dates(ttn_list)
+            if orders_with_ttn:
+                np_dates = await self.np_api.get_tracking_dates([ttn for _, ttn in orders_with_ttn])
                 
                 for order, ttn in orders_with_ttn:
                     real_date = np_dates.get(ttn)
@@ -92,37 +275,25 @@ class SitniksAPI:
                             filtered_orders.append(order)
             
             filtered_orders.sort(key=lambda x: x.get('_confirmed_date', datetime.min.date()))
+            ORDERS_PROCESSED.inc(scanned, status=target_status)
             return filtered_orders
 
-        # 2. ЛОГИКА "ВИКОНАНО"
-        for order in raw_orders:
-            if target_status and "виконано" in target_status:
-                dt_str = order.get('completedAt')
-                if not dt_str and "виконано" in order.get('status', {}).get('title', '').lower():
-                    dt_str = order.get('updatedAt')
-                
-                if dt_str:
-                    event_date = datetime.fromisoformat(dt_str.replace('Z', '')).date()
-                    if target_date_start <= event_date <= target_date_end:
-                        order['_confirmed_date'] = event_date
-                        order['_confirmed_event'] = "Закриття угоди"
-                        filtered_orders.append(order)
-                continue
-
-            # 3. ОСТАЛЬНЫЕ СТАТУСЫ
-            current_status = order.get('status', {}).get('title', '').lower()
-            if target_status and target_status not in current_status:
+        # 2. ВИКОНАНО И ОСТАЛЬНЫЕ СТАТУСЫ - фильтруем прямо в потоке
+        async for order in self.iter_orders(window_from, window_to, sync):
+            track('orders')
+            scanned += 1
+            match = self.match_event(order, target_status)
+            if not match:
                 continue
-
-            dt_str = order.get('updatedAt') or order.get('createdAt')
-            event_date = datetime.fromisoformat(dt_str.replace('Z', '')).date()
-            
+            event_date, event = match
             if target_date_start <= event_date <= target_date_end:
-                order['_confirmed_date'] = event_date
-                order['_confirmed_event'] = "Зміна статусу"
-                filtered_orders.append(order)
+                slim = slim_order(order)
+                slim['_confirmed_date'] = event_date
+                slim['_confirmed_event'] = event
+                filtered_orders.append(slim)
 
         filtered_orders.sort(key=lambda x: x.get('_confirmed_date', datetime.min.date()))
+        ORDERS_PROCESSED.inc(scanned, status=target_status or "всі")
         return filtered_orders
 
     # === РЕЖИМ 2: БИБЛИОТЕКАРЬ (АРХИВ) ===
@@ -130,47 +301,21 @@ class SitniksAPI:
     # НЕ делает запросы к НП (экономит время).
     async def get_orders_by_specific_ids(self, date_obj, target_ids):
         """
-        Берет заказы за дату и оставляет только те, что есть в списке target_ids.
+        Заказы из списка target_ids, отправленные в date_obj (дата уже известна из архива).
+        Нужны для дней из старой схемы, где в архиве остались только номера заказов.
         """
-        # Берем узкий диапазон дат (дата события +/- 5 дней), чтобы не качать всю базу
-        d_start = date_obj - timedelta(days=5)
-        d_end = date_obj + timedelta(days=5)
-        
-        raw_orders = []
-        limit = 50
-        skip = 0
-        
-        async with aiohttp.ClientSession() as session:
-            while True:
-                params = {
-                    'limit': limit,
-                    'skip': skip,
-                    'dateFrom': d_start.strftime('%Y-%m-%d'),
-                    'dateTo': d_end.strftime('%Y-%m-%d')
-                }
-                url = f"{self.base_url}/orders"
-                try:
-                    async with session.get(url, headers=self.headers, params=params) as resp:
-                        if resp.status != 200: break
-                        data = await resp.json()
-                        batch = data.get('data', [])
-                        if not batch: break
-                        raw_orders.extend(batch)
-                        if len(batch) < limit: break
-                        skip += limit
-                except:
-                    break
-        
-        # Фильтруем по списку "золотых" ID
-        target_ids_str = [str(i) for i in target_ids]
+        # Отправленный в date_obj заказ создан не раньше, чем за запас "Відправлено"
+        d_start, d_end = self.fetch_window(date_obj, date_obj, "Відправлено")
+        target_ids_str = {str(i) for i in target_ids}
         filtered = []
-        
-        for order in raw_orders:
+
+        async for order in self.iter_orders(d_start, d_end):
             o_id = str(order.get('orderNumber') or order.get('id'))
             if o_id in target_ids_str:
                 # Восстанавливаем метку для красивого отчета
-                order['_confirmed_date'] = date_obj
-                order['_confirmed_event'] = "Фактична відправка (НП)"
-                filtered.append(order)
-                
-        return filtered
\ No newline at end of file
+                slim = slim_order(order)
+                slim['_confirmed_date'] = date_obj
+                slim['_confirmed_event'] = "Фактична відправка (НП)"
+                filtered.append(slim)
+
+        return filtered
@@ -1,81 +1,441 @@
 import sqlite3
 import json
+import zlib
 import logging
 from datetime import datetime
 
+from .async_db import AsyncDB
+
 DB_NAME = "bot_stats.db"
 
+# Версия схемы (PRAGMA user_version)
+# 1 - отправки вынесены из JSON daily_stats.order_ids в таблицу shipments
+# 2 - в shipments хранится сжатый снимок заказа для отчетов из архива
+# 3 - daily_stats.provisional: день собран внутри дня и еще не закрыт
+SCHEMA_VERSION = 3
+
 def init_db():
-    """Создает таблицу, если её нет."""
+    """Создает таблицы, если их нет, и мигрирует старую схему."""
     conn = sqlite3.connect(DB_NAME)
     c = conn.cursor()
-    # Таблица хранит: дату, кол-во, сумму и список ID заказов (на всякий случай)
+    # WAL: запросы бота идут из нескольких потоков (см. async_db), читатели не ждут писателя
+    c.execute("PRAGMA journal_mode=WAL")
+    # Реестр дней: какие дни уже собраны + итоги дня
     c.execute('''
         CREATE TABLE IF NOT EXISTS daily_stats (
             date TEXT PRIMARY KEY,
             count INTEGER,
             total_sum REAL,
             order_ids TEXT,
-            updated_at TEXT
+            updated_at TEXT,
+            provisional INTEGER DEFAULT 0
+        )
+    ''')
+    # Одна строка = один отправленный заказ
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS shipments (
+            ship_date TEXT NOT NULL,
+            order_number TEXT NOT NULL,
+            ttn TEXT,
+            status TEXT,
+            total_price REAL,
+            snapshot BLOB,
+            PRIMARY KEY (ship_date, order_number)
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_shipments_order ON shipments (order_number)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_shipments_ttn ON shipments (ttn)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_shipments_status ON shipments (status, ship_date)")
+    # Дневные сводки по всем статусам: итог дня + какие заказы в него вошли
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS daily_rollups (
+            date TEXT NOT NULL,
+            status TEXT NOT NULL,
+            count INTEGER,
+            total_sum REAL,
+            updated_at TEXT,
+            PRIMARY KEY (status, date)
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS rollup_orders (
+            date TEXT NOT NULL,
+            status TEXT NOT NULL,
+            order_number TEXT NOT NULL,
+            snapshot BLOB,
+            PRIMARY KEY (status, date, order_number)
         )
     ''')
+
+    version = c.execute("PRAGMA user_version").fetchone()[0]
+    if version < 1:
+        _migrate_order_ids(c)
+    if version < 2:
+        _migrate_snapshots(c)
+    if version < 3:
+        _migrate_provisional(c)
+    c.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
     conn.commit()
     conn.close()
     logging.info("📁 База данных инициализирована.")
 
-def save_daily_stats(date_obj, count, total_sum, order_ids_list):
-    """Записывает или обновляет статистику за день."""
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    
-    date_str = date_obj.strftime("%Y-%m-%d")
-    ids_json = json.dumps(order_ids_list) # Сохраняем список ID как текст
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+def _migrate_order_ids(c):
+    """
+    Переносит старые JSON-списки daily_stats.order_ids в shipments.
+    ТТН, статус и сумму подтягиваем из локального зеркала заказов, если оно уже есть.
+    """
+    has_orders = c.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'orders'"
+    ).fetchone()
+
+    rows = c.execute("SELECT date, order_ids FROM daily_stats WHERE order_ids IS NOT NULL").fetchall()
+    moved = 0
+    for date_str, ids_json in rows:
+        try:
+            ids = json.loads(ids_json)
+        except (TypeError, ValueError):
+            ids = []
+        for o_id in ids:
+            ttn, status, price = None, None, None
+            if has_orders:
+                found = c.execute(
+                    "SELECT ttn, status_title, data FROM orders WHERE order_number = ? OR id = ?",
+                    (str(o_id), str(o_id))
+                ).fetchone()
+                if found:
+                    ttn, status = found[0], found[1]
+                    price = float(json.loads(found[2]).get('totalPrice', 0))
+            c.execute('''
+                INSERT OR IGNORE INTO shipments (ship_date, order_number, ttn, status, total_price)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (date_str, str(o_id), ttn, status, price))
+            moved += 1
+    c.execute("UPDATE daily_stats SET order_ids = NULL")
+    if rows:
+        logging.info(f"🔀 Миграция: {moved} заказов за {len(rows)} дн. перенесены в shipments")
+
+def _migrate_snapshots(c):
+    """Добавляет колонку snapshot (в базах схемы 1) и заполняет ее из зеркала заказов."""
+    columns = [row[1] for row in c.execute("PRAGMA table_info(shipments)").fetchall()]
+    if 'snapshot' not in columns:
+        c.execute("ALTER TABLE shipments ADD COLUMN snapshot BLOB")
+
+    has_orders = c.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'orders'"
+    ).fetchone()
+    if not has_orders:
+        return
+    # Импорт здесь: crm_api -> order_store -> db, иначе получим циклический импорт
+    from .crm_api import slim_order
+    rows = c.execute('''
+        SELECT s.ship_date, s.order_number, o.data FROM shipments s
+        JOIN orders o ON o.order_number = s.order_number
+        WHERE s.snapshot IS NULL
+    ''').fetchall()
+    for ship_date, order_number, data in rows:
+        c.execute("UPDATE shipments SET snapshot = ? WHERE ship_date = ? AND order_number = ?",
+                  (pack_snapshot(slim_order(json.loads(data))), ship_date, order_number))
+
+def _migrate_provisional(c):
+    """Колонка provisional в daily_stats (уже собранные дни - закрытые)."""
+    columns = [row[1] for row in c.execute("PRAGMA table_info(daily_stats)").fetchall()]
+    if 'provisional' not in columns:
+        c.execute("ALTER TABLE daily_stats ADD COLUMN provisional INTEGER DEFAULT 0")
+
+def pack_snapshot(order):
+    """Сжатый снимок заказа (только поля для отчета, без служебных _полей)."""
+    clean = {k: v for k, v in order.items() if not k.startswith('_')}
+    return zlib.compress(json.dumps(clean, ensure_ascii=False).encode('utf-8'))
+
+def unpack_snapshot(blob):
+    return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+# === ДОСТУП ИЗ БОТА ===
+# Все функции ниже - корутины: запросы идут через постоянные соединения AsyncDB
+# в отдельных потоках, event loop не блокируется. Сами запросы - в _функциях с курсором.
+
+_db = None
+
+def get_db():
+    global _db
+    if _db is None:
+        _db = AsyncDB(DB_NAME)
+    return _db
+
+def close_db():
+    """Закрывает соединения (при остановке бота; следующий get_db() откроет новые)."""
+    global _db
+    if _db is not None:
+        _db.close()
+        _db = None
+
+def iso_day(date_obj):
+    """Дата -> ключ дня в таблицах ('ГГГГ-ММ-ДД')."""
+    return date_obj.strftime("%Y-%m-%d")
+
+def order_ttn(order):
+    return (order.get('delivery') or {}).get('billOfLading') or \
+           (order.get('npDelivery') or {}).get('billOfLading')
+
+def _order_row(date_str, order):
+    return (
+        date_str,
+        str(order.get('orderNumber') or order.get('id')),
+        order_ttn(order),
+        (order.get('status') or {}).get('title'),
+        float(order.get('totalPrice', 0)),
+        pack_snapshot(order),
+    )
+
+def _write_day(c, date_obj, orders, now, provisional):
+    date_str = iso_day(date_obj)
+    if provisional:
+        # Промежуточный проход мог закончиться уже после закрывающего (23:50):
+        # закрытый день обратно в промежуточные не переводим
+        c.execute("SELECT provisional FROM daily_stats WHERE date = ?", (date_str,))
+        row = c.fetchone()
+        if row and not row[0]:
+            return None
+    count = len(orders)
+    # Считаем сумму, учитывая возможные ошибки в данных (float)
+    total_sum = sum(float(o.get('totalPrice', 0)) for o in orders)
 
     # Используем INSERT OR REPLACE, чтобы обновлять данные, если скрипт запустится дважды
     c.execute('''
-        INSERT OR REPLACE INTO daily_stats (date, count, total_sum, order_ids, updated_at)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (date_str, count, total_sum, ids_json, now))
-    
-    conn.commit()
-    conn.close()
-    logging.info(f"💾 Статистика за {date_str} сохранена: {count} шт. | {total_sum} грн")
+        INSERT OR REPLACE INTO daily_stats (date, count, total_sum, order_ids, updated_at, provisional)
+        VALUES (?, ?, ?, NULL, ?, ?)
+    ''', (date_str, count, total_sum, now, int(provisional)))
+    c.execute("DELETE FROM shipments WHERE ship_date = ?", (date_str,))
+    c.executemany('''
+        INSERT OR REPLACE INTO shipments (ship_date, order_number, ttn, status, total_price, snapshot)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', [_order_row(date_str, o) for o in orders])
+    return count, total_sum
+
+def _write_days(c, rows, provisional=False):
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return [_write_day(c, date_obj, orders, now, provisional) for date_obj, orders in rows]
 
-def get_stats_for_period(date_start, date_end):
+async def save_daily_stats_bulk(rows, provisional=False):
     """
-    (На будущее) Получить сохраненную статистику.
+    Пишет отправки сразу за много дней одной транзакцией.
+    rows - список (date_obj, orders).
+    provisional=True - день еще идет (сбор внутри дня): в архив отчетов он не попадет,
+    пока его не перепишет закрывающий проход (23:50, сверка или догрузка пропусков).
+    Уже закрытые дни промежуточная запись не трогает.
     """
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+    await get_db().write(_write_days, rows, provisional)
+    logging.info(f"💾 Статистика сохранена за {len(rows)} дн. одной транзакцией")
+
+def _stats_for_period(c, date_start, date_end):
     c.execute('''
-        SELECT date, count, total_sum FROM daily_stats 
-        WHERE date >= ? AND date <= ?
-        ORDER BY date
-    ''', (date_start.strftime("%Y-%m-%d"), date_end.strftime("%Y-%m-%d")))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+        SELECT d.date,
+               COUNT(s.order_number),
+               CASE WHEN COUNT(s.total_price) < COUNT(s.order_number)
+                    THEN d.total_sum
+                    ELSE COALESCE(SUM(s.total_price), 0.0) END
+        FROM daily_stats d
+        LEFT JOIN shipments s ON s.ship_date = d.date
+        WHERE d.date >= ? AND d.date <= ? AND NOT d.provisional
+        GROUP BY d.date
+        ORDER BY d.date
+    ''', (iso_day(date_start), iso_day(date_end)))
+    return c.fetchall()
 
-    # Файл: services/db.py
-# ... (код выше оставляем без изменений) ...
+async def get_stats_for_period(date_start, date_end):
+    """
+    Статистика по дням: (date, count, total_sum).
+    Считается агрегатом по shipments. Для дней, перенесенных из старой схемы
+    без сумм заказов, берется сохраненная сумма дня.
+    """
+    return await get_db().read(_stats_for_period, date_start, date_end)
+
+def _day_collected(c, date_str):
+    c.execute("SELECT 1 FROM daily_stats WHERE date = ?", (date_str,))
+    return c.fetchone() is not None
 
-def get_saved_ids_for_date(date_obj):
+def _saved_ids_for_date(c, date_obj):
+    date_str = iso_day(date_obj)
+    if not _day_collected(c, date_str):
+        return None
+    c.execute("SELECT order_number FROM shipments WHERE ship_date = ? ORDER BY order_number", (date_str,))
+    return [row[0] for row in c.fetchall()]
+
+async def get_saved_ids_for_date(date_obj):
     """
-    Возвращает список ID заказов за конкретную дату, если они есть в базе.
+    Возвращает список ID заказов за конкретную дату, если день есть в базе.
+    None - день еще не собирали.
     """
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    date_str = date_obj.strftime("%Y-%m-%d")
-    
-    c.execute("SELECT order_ids FROM daily_stats WHERE date = ?", (date_str,))
-    row = c.fetchone()
-    conn.close()
-    
-    if row:
-        # row[0] это строка "[2107, 2108]", превращаем её обратно в список Python
-        try:
-            return json.loads(row[0])
-        except:
-            return []
-    return None
\ No newline at end of file
+    return await get_db().read(_saved_ids_for_date, date_obj)
+
+def _archived_orders(c, date_obj):
+    date_str = iso_day(date_obj)
+    if not _day_collected(c, date_str):
+        return None
+
+    c.execute('''
+        SELECT order_number, ttn, status, total_price, snapshot FROM shipments
+        WHERE ship_date = ? ORDER BY order_number
+    ''', (date_str,))
+    orders = []
+    for order_number, ttn, status, total_price, snapshot in c.fetchall():
+        if snapshot:
+            order = unpack_snapshot(snapshot)
+        else:
+            # Перенесен из старой схемы: есть только номер (и, может быть, ТТН/сумма из зеркала).
+            # report_planner подтянет такие заказы из CRM и допишет снимок
+            order = {
+                'orderNumber': order_number,
+                'totalPrice': total_price or 0,
+                'delivery': {'billOfLading': ttn},
+                '_no_snapshot': True,
+            }
+        # Статус в колонке свежее снимка (его обновляет фоновая сверка с CRM)
+        if status:
+            order['status'] = {'title': status}
+        order['_confirmed_date'] = date_obj
+        order['_confirmed_event'] = "Фактична відправка (НП)"
+        orders.append(order)
+    return orders
+
+async def get_archived_orders(date_obj):
+    """
+    Заказы за день целиком из архива (режим "Библиотекарь" без сети).
+    None - день еще не собирали.
+    Для строк без снимка (перенесены из старой схемы) собираем заказ из колонок
+    и помечаем _no_snapshot - их надо восстановить через restore_snapshots.
+    """
+    return await get_db().read(_archived_orders, date_obj)
+
+def _restore_snapshots(c, date_obj, orders):
+    rows = [_order_row(iso_day(date_obj), o) for o in orders]
+    c.executemany('''
+        UPDATE shipments SET ttn = ?, status = ?, total_price = ?, snapshot = ?
+        WHERE ship_date = ? AND order_number = ? AND snapshot IS NULL
+    ''', [(ttn, status, price, snapshot, date_str, number)
+          for date_str, number, ttn, status, price, snapshot in rows])
+    return c.rowcount
+
+async def restore_snapshots(date_obj, orders):
+    """Дописывает снимок, ТТН, статус и сумму заказам дня, у которых снимка не было."""
+    restored = await get_db().write(_restore_snapshots, date_obj, orders)
+    logging.info(f"🩹 Архив {iso_day(date_obj)}: восстановлено снимков {restored}")
+
+def _archived_dates(c, date_start, date_end, provisional=0):
+    c.execute("SELECT date FROM daily_stats WHERE date >= ? AND date <= ? AND provisional = ?",
+              (iso_day(date_start), iso_day(date_end), provisional))
+    return {datetime.strptime(row[0], "%Y-%m-%d").date() for row in c.fetchall()}
+
+async def get_archived_dates(date_start, date_end):
+    """Множество дат периода, которые уже закрыты в архиве отправок (без промежуточных)."""
+    return await get_db().read(_archived_dates, date_start, date_end)
+
+async def get_provisional_dates(date_start, date_end):
+    """Дни, собранные только промежуточным проходом (их нужно закрыть)."""
+    return await get_db().read(_archived_dates, date_start, date_end, 1)
+
+def _archived_order_numbers(c, date_start, date_end):
+    c.execute('''
+        SELECT DISTINCT order_number FROM shipments
+        WHERE ship_date >= ? AND ship_date <= ?
+    ''', (iso_day(date_start), iso_day(date_end)))
+    return [row[0] for row in c.fetchall()]
+
+async def get_archived_order_numbers(date_start, date_end):
+    """Номера заказов из архива за период (для фоновой сверки статусов)."""
+    return await get_db().read(_archived_order_numbers, date_start, date_end)
+
+def _update_shipment_statuses(c, statuses):
+    c.executemany(
+        "UPDATE shipments SET status = ? WHERE order_number = ? AND (status IS NULL OR status != ?)",
+        [(status, number, status) for number, status in statuses.items()]
+    )
+    return c.rowcount
+
+async def update_shipment_statuses(statuses):
+    """statuses - {order_number: актуальный статус CRM}. Возвращает кол-во обновленных строк."""
+    if not statuses:
+        return 0
+    return await get_db().write(_update_shipment_statuses, statuses)
+
+# === ДНЕВНЫЕ СВОДКИ ПО ВСЕМ СТАТУСАМ ===
+
+def _write_rollups(c, date_obj, orders_by_status):
+    date_str = iso_day(date_obj)
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    for status, orders in orders_by_status.items():
+        status_key = status.strip().lower()
+        total_sum = sum(float(o.get('totalPrice', 0)) for o in orders)
+        c.execute('''
+            INSERT OR REPLACE INTO daily_rollups (date, status, count, total_sum, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (date_str, status_key, len(orders), total_sum, now))
+        c.execute("DELETE FROM rollup_orders WHERE status = ? AND date = ?", (status_key, date_str))
+        c.executemany('''
+            INSERT OR REPLACE INTO rollup_orders (date, status, order_number, snapshot)
+            VALUES (?, ?, ?, ?)
+        ''', [
+            (date_str, status_key, str(o.get('orderNumber') or o.get('id')), pack_snapshot(o))
+            for o in orders
+        ])
+
+async def save_daily_rollups(date_obj, orders_by_status):
+    """
+    Пишет сводки за день по всем статусам одной транзакцией.
+    orders_by_status - {статус: заказы из отчета}.
+    """
+    await get_db().write(_write_rollups, date_obj, orders_by_status)
+    logging.info(f"📊 Сводки за {iso_day(date_obj)} сохранены: {len(orders_by_status)} статусов")
+
+def _rolled_up_dates(c, date_start, date_end, status):
+    c.execute('''
+        SELECT date FROM daily_rollups
+        WHERE status = ? AND date >= ? AND date <= ?
+    ''', (status.strip().lower(), iso_day(date_start), iso_day(date_end)))
+    return {datetime.strptime(row[0], "%Y-%m-%d").date() for row in c.fetchall()}
+
+async def get_rolled_up_dates(date_start, date_end, status):
+    """Множество дат периода, для которых уже есть сводка по статусу."""
+    return await get_db().read(_rolled_up_dates, date_start, date_end, status)
+
+def _rollup_stats(c, date_start, date_end, status):
+    c.execute('''
+        SELECT date, count, total_sum FROM daily_rollups
+        WHERE status = ? AND date >= ? AND date <= ?
+        ORDER BY date
+    ''', (status.strip().lower(), iso_day(date_start), iso_day(date_end)))
+    return c.fetchall()
+
+async def get_rollup_stats(date_start, date_end, status):
+    """Итоги по дням из сводок: (date, count, total_sum)."""
+    return await get_db().read(_rollup_stats, date_start, date_end, status)
+
+def _rollup_orders(c, date_start, date_end, status):
+    c.execute('''
+        SELECT date, snapshot FROM rollup_orders
+        WHERE status = ? AND date >= ? AND date <= ?
+        ORDER BY date, order_number
+    ''', (status.strip().lower(), iso_day(date_start), iso_day(date_end)))
+    orders = []
+    for date_str, snapshot in c.fetchall():
+        order = unpack_snapshot(snapshot)
+        order['_confirmed_date'] = datetime.strptime(date_str, "%Y-%m-%d").date()
+        orders.append(order)
+    return orders
+
+async def get_rollup_orders(date_start, date_end, status):
+    """Заказы из сводок за период (с датой события из сводки)."""
+    return await get_db().read(_rollup_orders, date_start, date_end, status)
+
+def _shipment_amounts(c, date_start, date_end):
+    c.execute('''
+        SELECT total_price FROM shipments
+        WHERE ship_date >= ? AND ship_date <= ? AND total_price IS NOT NULL
+    ''', (iso_day(date_start), iso_day(date_end)))
+    return [row[0] for row in c.fetchall()]
+
+async def get_shipment_amounts(date_start, date_end):
+    """Суммы всех заказов архива за период (для перцентилей чека)."""
+    return await get_db().read(_shipment_amounts, date_start, date_end)
@@ -0,0 +1,37 @@
+# Файл: services/http_client.py
+import os
+import aiohttp
+from contextlib import asynccontextmanager
+
+# Пул соединений: держим keep-alive, чтобы не платить за TCP+TLS на каждый отчет
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", 100))
+HTTP_PER_HOST_LIMIT = int(os.getenv("HTTP_PER_HOST_LIMIT", 20))
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", 300))
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", 60))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 60))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 10))
+
+
+def create_http_session():
+    """
+    Один долгоживущий клиент на процесс (CRM + Новая Почта).
+    Создается в main.main(), закрывается при остановке.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_PER_HOST_LIMIT,
+        ttl_dns_cache=HTTP_DNS_TTL,
+        keepalive_timeout=HTTP_KEEPALIVE,
+    )
+    timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+@asynccontextmanager
+async def session_scope(session=None):
+    """Отдает общий клиент, а если его не передали (скрипты) - временный."""
+    if session is not None:
+        yield session
+        return
+    async with create_http_session() as temp_session:
+        yield temp_session
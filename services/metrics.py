@@ -0,0 +1,140 @@
+# Файл: services/metrics.py
+import time
+import functools
+import threading
+
+# Границы бакетов гистограмм (секунды)
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_str(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, n=1, **labels):
+        key = tuple(labels.get(l, "") for l in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + n
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_label_str(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # key -> [counts по бакетам..., sum, count]
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(l, "") for l in self.labels)
+        with self._lock:
+            data = self._values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def time(self, **labels):
+        """Контекстный менеджер: with histogram.time(label=...): ..."""
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for key, data in sorted(self._values.items()):
+            for i, bound in enumerate(self.buckets):
+                le = _label_str(self.labels + ("le",), key + (bound,))
+                lines.append(f"{self.name}_bucket{le} {data[i]}")
+            le = _label_str(self.labels + ("le",), key + ("+Inf",))
+            lines.append(f"{self.name}_bucket{le} {data[-1]}")
+            lines.append(f"{self.name}_sum{_label_str(self.labels, key)} {data[-2]}")
+            lines.append(f"{self.name}_count{_label_str(self.labels, key)} {data[-1]}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+REGISTRY = []
+
+
+def render_metrics():
+    """Все метрики в текстовом формате Prometheus."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# === МЕТРИКИ БОТА ===
+
+CRM_PAGE_SECONDS = Histogram("crm_page_seconds", "Latency of one CRM /orders page request", ["outcome"])
+CRM_HTTP_ERRORS = Counter("crm_http_errors_total", "CRM page request failures", ["reason"])
+NP_CHUNK_SECONDS = Histogram("np_chunk_seconds", "Latency of one Nova Poshta 100-TTN chunk", ["key"])
+NP_HTTP_ERRORS = Counter("np_http_errors_total", "Nova Poshta chunk failures per API key", ["key"])
+REPORT_SECONDS = Histogram("report_seconds", "End-to-end report generation", ["status", "source"])
+ORDERS_PROCESSED = Counter("orders_processed_total", "Orders scanned by live reports", ["status"])
+TTNS_RESOLVED = Counter("ttns_resolved_total", "TTNs resolved to a shipping date", ["source"])
+JOB_SECONDS = Histogram("scheduler_job_seconds", "Scheduler job duration", ["job"])
+JOB_RUNS = Counter("scheduler_job_runs_total", "Scheduler job runs by outcome", ["job", "outcome"])
+BREAKER_OPENED = Counter("circuit_breaker_open_total", "Circuit breaker trips per endpoint", ["endpoint"])
+REPORTS_INCOMPLETE = Counter("reports_incomplete_total", "Reports built from partial data", ["status"])
+
+
+def key_label(api_key):
+    """Ключи НП в метриках не светим целиком."""
+    return f"...{api_key[-4:]}"
+
+
+def instrument_job(name):
+    """Декоратор для задач планировщика: длительность и исход (ok/error)."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception:
+                JOB_RUNS.inc(job=name, outcome="error")
+                raise
+            finally:
+                JOB_SECONDS.observe(time.perf_counter() - started, job=name)
+            JOB_RUNS.inc(job=name, outcome="ok")
+            return result
+        return wrapper
+    return decorator
@@ -1,11 +1,73 @@
 # Файл: services/novaposhta_api.py
 import os
-import aiohttp
+import time
+import asyncio
 import logging
 from datetime import datetime
+from .http_client import session_scope
+from .ttn_cache import TTNCache
+from .report_jobs import track
+from .metrics import NP_CHUNK_SECONDS, NP_HTTP_ERRORS, TTNS_RESOLVED, key_label
+from .resilience import AdaptiveLimit, get_breaker, backoff_delay, retry_after, is_throttle, note_gap
+
+CHUNK_SIZE = 100
+# Лимит запросов в секунду на ОДИН ключ (и размер "пачки" запросов подряд)
+KEY_RPS = float(os.getenv("NP_KEY_RPS", 2))
+KEY_BURST = int(os.getenv("NP_KEY_BURST", 2))
+# Пауза для ключа, который словил ошибку/троттлинг (верхняя граница, с разбросом)
+KEY_COOLDOWN = float(os.getenv("NP_KEY_COOLDOWN", 5))
+# Сколько раз чанк, на котором споткнулись ВСЕ ключи, пробуем заново (после паузы)
+CHUNK_ROUNDS = int(os.getenv("NP_CHUNK_ROUNDS", 3))
+NP_BREAKER = get_breaker("novaposhta")
+
+
+class NPChunkError(Exception):
+    """Ключ не смог обработать чанк (HTTP-ошибка, троттлинг, success=false)."""
+
+    def __init__(self, message, throttled=False, retry_after=None):
+        super().__init__(message)
+        self.throttled = throttled
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Простейший token bucket: не больше rate запросов в секунду, пачками до capacity."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# Квота НП - на ключ, а не на экземпляр клиента: отчеты и фоновые задачи
+# делят одни и те же bucket'ы и AIMD-лимиты (как CRM_LIMIT и breaker'ы)
+_key_limits = {}
+
+
+def get_key_limits(api_key):
+    """(TokenBucket, AdaptiveLimit) ключа, общие на процесс."""
+    if api_key not in _key_limits:
+        _key_limits[api_key] = (TokenBucket(KEY_RPS, KEY_BURST),
+                                AdaptiveLimit(KEY_RPS, minimum=0.2, step=0.05))
+    return _key_limits[api_key]
+
 
 class NovaPoshtaAPI:
-    def __init__(self):
+    def __init__(self, session=None):
+        self.session = session
         self.api_keys = []
         i = 1
         while True:
@@ -18,7 +80,11 @@ class NovaPoshtaAPI:
         if not self.api_keys and os.getenv("NP_API_KEY"):
             self.api_keys.append(os.getenv("NP_API_KEY"))
 
-        self.url = "https://api.novaposhta.ua/v2.0/json/"
+        self.url = os.getenv("NP_API_URL", "https://api.novaposhta.ua/v2.0/json/")
+        self.cache = TTNCache()
+        # Скорость ключа проседает при троттлинге и восстанавливается на успехах
+        self.buckets = {key: get_key_limits(key)[0] for key in self.api_keys}
+        self.limits = {key: get_key_limits(key)[1] for key in self.api_keys}
 
     def _parse_date(self, date_str):
         if not date_str: return None
@@ -32,72 +98,174 @@ class NovaPoshtaAPI:
         except: pass
         return None
 
+    def _parse_item(self, item):
+        """
+        Разбирает ответ НП по одной ТТН.
+        Возвращает (дата отправки или None, resolved).
+        resolved=True - ответ окончательный и его можно кэшировать навсегда.
+        """
+        # === ЛОГИКА V4 (БРОНЕБІЙНА) ===
+
+        # 1. ПЕРЕВІРКА СТАТУСУ
+        # Код 1 = "Нова пошта очікує надходження" (Тільки створено)
+        status_code = item.get('StatusCode')
+        if str(status_code) == "1":
+            return None, False # Це просто папірець, перевіримо пізніше
+
+        # 2. Отримуємо дати
+        date_scan_str = item.get('DateScan')
+        date_create_str = item.get('DateCreated')
+
+        if not date_scan_str:
+            return None, False
+
+        dt_scan = self._parse_date(date_scan_str)
+        dt_create = self._parse_date(date_create_str)
+
+        if dt_scan and dt_create:
+            # 3. ПЕРЕВІРКА СВІЖОСТІ (Щоб прибрати "привидів" з минулого місяця)
+            delta = (dt_scan - dt_create).days
+            if delta > 2:
+                return None, True # Привид - таким і залишиться
+
+            # Якщо пройшли всі фільтри - це реальна відправка
+            return dt_create, True
+        elif dt_scan:
+            return dt_scan, True
+        return None, False
+
     async def get_tracking_dates(self, ttn_list):
         if not self.api_keys: return {}
-        final_results = {}
-        pending_ttns = set(ttn_list)
-
-        for api_key in self.api_keys:
-            if not pending_ttns: break
-            current_batch_list = list(pending_ttns)
-            found_data = await self._query_chunked(api_key, current_batch_list)
-            for ttn, date_val in found_data.items():
+        unique_ttns = list(dict.fromkeys(ttn_list))
+
+        # 1. Берем из кэша все, что уже известно
+        cached, misses = await self.cache.lookup(unique_ttns)
+        final_results = {ttn: d for ttn, d in cached.items() if d}
+        logging.info(f"📦 ТТН: {len(cached)} из кэша, {len(misses)} спрашиваем у НП")
+        track('ttns', len(cached))
+
+        # 2. У НП спрашиваем только промахи (все ключи параллельно)
+        fresh, lost = await self._dispatch(misses)
+        if lost:
+            # Без ответа НП - не "не найдено": в кэш не пишем и отчет помечаем неполным
+            note_gap(f"НП не ответила по {len(lost)} ТТН из {len(misses)}")
+
+        # Не найденные - тоже "ждем", перепроверим после TTL
+        lost = set(lost)
+        for ttn in misses:
+            if ttn not in lost:
+                fresh.setdefault(ttn, (None, False))
+        await self.cache.store(fresh)
+
+        for ttn, (date_val, _) in fresh.items():
+            if date_val:
                 final_results[ttn] = date_val
-                if ttn in pending_ttns: pending_ttns.remove(ttn)
+        TTNS_RESOLVED.inc(sum(1 for d in cached.values() if d), source="cache")
+        TTNS_RESOLVED.inc(sum(1 for d, _ in fresh.values() if d), source="api")
         return final_results
 
-    async def _query_chunked(self, api_key, ttn_list):
-        chunk_size = 100
+    async def _dispatch(self, ttn_list):
+        """
+        Раздает чанки по 100 ТТН всем ключам одновременно.
+        У каждого ключа свой token bucket. Чанк, на котором ключ споткнулся,
+        возвращается в очередь и достается другому ключу. Если споткнулись все ключи -
+        чанк пробуем заново после паузы (до CHUNK_ROUNDS раз).
+        Возвращает (результаты, ТТН без ответа).
+        """
         results = {}
-        async with aiohttp.ClientSession() as session:
-            for i in range(0, len(ttn_list), chunk_size):
-                chunk = ttn_list[i:i + chunk_size]
-                documents = [{"DocumentNumber": ttn, "Phone": ""} for ttn in chunk]
-                payload = {
-                    "apiKey": api_key,
-                    "modelName": "TrackingDocument",
-                    "calledMethod": "getStatusDocuments",
-                    "methodProperties": {"Documents": documents}
-                }
-                try:
-                    async with session.post(self.url, json=payload) as resp:
-                        if resp.status == 200:
-                            data = await resp.json()
-                            if data.get('success'):
-                                for item in data.get('data', []):
-                                    number = item.get('Number')
-                                    
-                                    # === ЛОГИКА V4 (БРОНЕБІЙНА) ===
-                                    
-                                    # 1. ПЕРЕВІРКА СТАТУСУ
-                                    # Код 1 = "Нова пошта очікує надходження" (Тільки створено)
-                                    status_code = item.get('StatusCode')
-                                    if str(status_code) == "1":
-                                        continue # Це просто папірець, ігноруємо!
-
-                                    # 2. Отримуємо дати
-                                    date_scan_str = item.get('DateScan')
-                                    date_create_str = item.get('DateCreated')
-                                    
-                                    if not date_scan_str:
-                                        continue 
-                                    
-                                    dt_scan = self._parse_date(date_scan_str)
-                                    dt_create = self._parse_date(date_create_str)
-                                    
-                                    if dt_scan and dt_create:
-                                        # 3. ПЕРЕВІРКА СВІЖОСТІ (Щоб прибрати "привидів" з минулого місяця)
-                                        delta = (dt_scan - dt_create).days
-                                        if delta > 2:
-                                            continue
-                                        
-                                        # Якщо пройшли всі фільтри - це реальна відправка
-                                        results[number] = dt_create
-                                    elif dt_scan:
-                                        results[number] = dt_scan
+        lost = []
+        if not ttn_list:
+            return results, lost
+
+        queue = asyncio.Queue()
+        for i in range(0, len(ttn_list), CHUNK_SIZE):
+            queue.put_nowait((ttn_list[i:i + CHUNK_SIZE], set(), 1))
 
+        async def worker(session, api_key):
+            bucket = self.buckets[api_key]
+            limit = self.limits[api_key]
+            while True:
+                chunk, failed_keys, round_no = await queue.get()
+                cooldown = 0
+                try:
+                    if api_key in failed_keys:
+                        # Этот ключ уже падал на чанке - отдаем его другим
+                        queue.put_nowait((chunk, failed_keys, round_no))
+                        await asyncio.sleep(0.05)
+                        continue
+                    if not NP_BREAKER.allow():
+                        lost.extend(chunk)
+                        continue
+                    await bucket.acquire()
+                    try:
+                        with NP_CHUNK_SECONDS.time(key=key_label(api_key)):
+                            results.update(await self._query_chunk(session, api_key, chunk))
+                        NP_BREAKER.record_success()
+                        limit.on_success()
+                        bucket.rate = limit.value
+                        track('ttns', len(chunk))
+                    except NPChunkError as e:
+                        NP_HTTP_ERRORS.inc(key=key_label(api_key))
+                        if e.throttled:
+                            limit.on_throttle()
+                            bucket.rate = limit.value
+                        else:
+                            NP_BREAKER.record_failure()
+                        failed_keys.add(api_key)
+                        cooldown = e.retry_after if e.retry_after is not None else backoff_delay(1, base=KEY_COOLDOWN)
+                        if len(failed_keys) < len(self.api_keys):
+                            logging.warning(f"NP ключ {key_label(api_key)}: {e}. Чанк уходит другому ключу")
+                            queue.put_nowait((chunk, failed_keys, round_no))
+                        elif round_no < CHUNK_ROUNDS:
+                            delay = backoff_delay(round_no + 1)
+                            logging.warning(f"NP: чанк из {len(chunk)} ТТН не обработал ни один ключ ({e}), "
+                                            f"повтор {round_no + 1}/{CHUNK_ROUNDS} через {delay:.1f} c")
+                            # Кладем обратно ДО task_done, иначе join() решит, что очередь пуста
+                            await asyncio.sleep(delay)
+                            queue.put_nowait((chunk, set(), round_no + 1))
+                            cooldown = 0
                         else:
-                            logging.error(f"NP HTTP Error: {resp.status}")
-                except Exception as e:
-                    logging.error(f"NP Connection Error: {e}")
-        return results
\ No newline at end of file
+                            logging.error(f"NP: чанк из {len(chunk)} ТТН так и не обработан: {e}")
+                            lost.extend(chunk)
+                finally:
+                    queue.task_done()
+                if cooldown:
+                    # Ключ отдыхает, не держа чанков - их заберут остальные
+                    await asyncio.sleep(cooldown)
+
+        async with session_scope(self.session) as session:
+            workers = [asyncio.create_task(worker(session, key)) for key in self.api_keys]
+            try:
+                await queue.join()
+            finally:
+                for w in workers:
+                    w.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+        return results, lost
+
+    async def _query_chunk(self, session, api_key, chunk):
+        documents = [{"DocumentNumber": ttn, "Phone": ""} for ttn in chunk]
+        payload = {
+            "apiKey": api_key,
+            "modelName": "TrackingDocument",
+            "calledMethod": "getStatusDocuments",
+            "methodProperties": {"Documents": documents}
+        }
+        try:
+            async with session.post(self.url, json=payload) as resp:
+                if resp.status != 200:
+                    throttled = is_throttle(resp.status, resp.headers)
+                    raise NPChunkError(f"NP HTTP Error: {resp.status}", throttled=throttled,
+                                       retry_after=retry_after(resp.headers) if throttled else None)
+                data = await resp.json()
+        except NPChunkError:
+            raise
+        except Exception as e:
+            raise NPChunkError(f"NP Connection Error: {e}")
+
+        if not data.get('success'):
+            errors = data.get('errors')
+            # НП отвечает на лимит 200-кой с ошибкой "To many requests"
+            throttled = "many requests" in str(errors).lower()
+            raise NPChunkError(f"NP API Error: {errors}", throttled=throttled)
+        return {item.get('Number'): self._parse_item(item) for item in data.get('data', [])}
@@ -0,0 +1,228 @@
+# Файл: services/order_store.py
+import os
+import json
+import sqlite3
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from .db import DB_NAME, get_db, order_ttn
+
+# Одно и то же окно проходим не чаще раза в N секунд (утренний наплыв менеджеров):
+# запрос, пришедший следом, берет результат только что закончившегося прохода
+SYNC_MIN_INTERVAL = float(os.getenv("ORDER_SYNC_MIN_INTERVAL", 60))
+
+
+def _as_date(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+def _order_id(order):
+    return str(order.get('id') or order.get('orderNumber'))
+
+
+# === ЗАПРОСЫ (курсор первым аргументом, выполняются в пуле AsyncDB) ===
+
+# Сколько id/номеров подставляем в один IN (...)
+IN_CHUNK = 500
+
+
+def _chunks(items, size=IN_CHUNK):
+    return (items[i:i + size] for i in range(0, len(items), size))
+
+
+def _get_state(c, key):
+    c.execute("SELECT value FROM sync_state WHERE key = ?", (key,))
+    row = c.fetchone()
+    return row[0] if row else None
+
+
+def _set_state(c, key, value):
+    c.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, value))
+
+
+def _upsert_orders(c, orders):
+    # Сохраненные updatedAt всей страницы - одним запросом, а не SELECT на каждый заказ
+    ids = [_order_id(o) for o in orders]
+    saved = {}
+    for chunk in _chunks(ids):
+        c.execute(f"SELECT id, updated_at FROM orders WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+        saved.update(c.fetchall())
+
+    rows = []
+    for o_id, order in zip(ids, orders):
+        known = saved.get(o_id)
+        updated = order.get('updatedAt')
+        if known and (known == updated or (updated and known > updated)):
+            continue
+        rows.append((
+            o_id,
+            str(order.get('orderNumber') or ''),
+            (order.get('status') or {}).get('title', ''),
+            order.get('createdAt'),
+            updated,
+            order.get('completedAt'),
+            order_ttn(order),
+            json.dumps(order, ensure_ascii=False)
+        ))
+    c.executemany('''
+        INSERT OR REPLACE INTO orders
+            (id, order_number, status_title, created_at, updated_at, completed_at, ttn, data)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+    return len(rows)
+
+
+def _window_rowids(c, date_str, to_str):
+    c.execute('''
+        SELECT rowid FROM orders
+        WHERE created_at >= ? AND created_at < ?
+    ''', (date_str, to_str))
+    return [row[0] for row in c.fetchall()]
+
+
+def _orders_by_rowid(c, rowids):
+    c.execute(f"SELECT data FROM orders WHERE rowid IN ({','.join('?' * len(rowids))})", rowids)
+    return [json.loads(row[0]) for row in c.fetchall()]
+
+
+def _statuses(c, numbers):
+    statuses = {}
+    for chunk in _chunks(numbers):
+        c.execute(f'''
+            SELECT order_number, status_title FROM orders
+            WHERE order_number IN ({','.join('?' * len(chunk))})
+        ''', chunk)
+        statuses.update((number, status) for number, status in c.fetchall() if status)
+    return statuses
+
+
+class OrderStore:
+    """
+    Локальное зеркало заказов CRM (лежит в bot_stats.db).
+    Перед отчетом окно заказов проходится в CRM целиком, но в базу пишутся
+    только изменившиеся заказы, а сам отчет читает их отсюда порциями.
+    Запросы идут через AsyncDB (services/db.get_db) - вне event loop.
+    """
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self._init_tables()
+
+    def _init_tables(self):
+        # Один раз на процесс (клиент CRM общий), поэтому здесь можно синхронно
+        conn = sqlite3.connect(DB_NAME)
+        c = conn.cursor()
+        # WAL: фоновая синхронизация пишет, пока отчет читает зеркало порциями
+        # (в режиме журнала по умолчанию запись ждала бы читателя и упиралась в "database is locked")
+        c.execute("PRAGMA journal_mode=WAL")
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS orders (
+                id TEXT PRIMARY KEY,
+                order_number TEXT,
+                status_title TEXT,
+                created_at TEXT,
+                updated_at TEXT,
+                completed_at TEXT,
+                ttn TEXT,
+                data TEXT
+            )
+        ''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_orders_updated ON orders (updated_at)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_orders_created ON orders (created_at)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_orders_number ON orders (order_number)")
+        # Для разбора отчетов без CRM (services/report_explain.py): статус + дата события, закрытие, ТТН
+        c.execute("CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status_title, updated_at)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_orders_completed ON orders (completed_at)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_orders_ttn ON orders (ttn)")
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS sync_state (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+        conn.commit()
+        conn.close()
+
+    # --- СОСТОЯНИЕ СИНХРОНИЗАЦИИ ---
+
+    async def _get_state(self, key):
+        value = await get_db().read(_get_state, key)
+        return datetime.fromisoformat(value) if value else None
+
+    async def _set_state(self, key, value):
+        await get_db().write(_set_state, key, value.isoformat())
+
+    # --- ЗАПИСЬ ---
+
+    async def upsert_orders(self, orders):
+        """
+        Пишет только те заказы, у которых updatedAt новее сохраненного. Возвращает кол-во изменений.
+        Более старая версия (страница, скачанная раньше параллельной синхронизацией) не пишется.
+        Запись идет в потоке-писателе AsyncDB, event loop не ждет SQLite.
+        """
+        if not orders:
+            return 0
+        return await get_db().write(_upsert_orders, orders)
+
+    # --- ЧТЕНИЕ ---
+
+    async def iter_orders(self, date_from, date_to=None, page_size=500):
+        """
+        Заказы, созданные с date_from по date_to (если он задан). Читаем порциями по page_size.
+        Ровно то окно, которое sync() проходит в CRM: более старый заказ в зеркале
+        может быть с устаревшим статусом, поэтому по updatedAt его не подмешиваем.
+        """
+        date_str = date_from.strftime('%Y-%m-%d')
+        # Верхняя граница - начало следующего дня (created_at хранится с временем)
+        to_str = (date_to + timedelta(days=1)).strftime('%Y-%m-%d') if date_to else '9999-12-31'
+        db = get_db()
+        # Сначала только rowid окна (по индексам created_at/updated_at), потом порции по rowid
+        rowids = await db.read(_window_rowids, date_str, to_str)
+        for i in range(0, len(rowids), page_size):
+            for order in await db.read(_orders_by_rowid, rowids[i:i + page_size]):
+                yield order
+
+    async def get_statuses(self, order_numbers):
+        """{номер заказа: текущий статус CRM} для заказов, которые есть в зеркале."""
+        return await get_db().read(_statuses, [str(n) for n in order_numbers])
+
+    # --- СИНХРОНИЗАЦИЯ ---
+
+    async def sync(self, iter_pages, date_from, date_to=None):
+        """
+        Обновляет из CRM заказы, созданные с date_from по date_to (по умолчанию - по сегодня).
+        iter_pages(date_from, date_to) -> async-итератор страниц заказов
+        (обычно SitniksAPI.iter_order_pages). Каждая страница пишется сразу.
+        CRM фильтрует dateFrom/dateTo только по дате создания, курсора по updatedAt нет -
+        поэтому окно проходим целиком: иначе смену статуса у старого заказа не увидеть.
+        Если такое же или более широкое окно прошли меньше SYNC_MIN_INTERVAL назад - повторно не идем.
+        """
+        date_from = _as_date(date_from)
+        date_to = _as_date(date_to or datetime.now())
+        async with self._lock:
+            now = datetime.now()
+            last_sync = await self._get_state('last_sync')
+            synced_from = await self._get_state('synced_from')
+            synced_to = await self._get_state('synced_to')
+
+            if last_sync and synced_from and synced_to and \
+                    (now - last_sync).total_seconds() < SYNC_MIN_INTERVAL and \
+                    synced_from.date() <= date_from and synced_to.date() >= date_to:
+                return 0
+
+            changed = await self._pull(iter_pages, date_from, date_to, f"{date_from}..{date_to}")
+            # Время окончания прохода: долгий проход не должен сразу считаться устаревшим
+            await self._set_state('last_sync', datetime.now())
+            await self._set_state('synced_from', datetime.combine(date_from, datetime.min.time()))
+            await self._set_state('synced_to', datetime.combine(date_to, datetime.min.time()))
+            return changed
+
+    async def _pull(self, iter_pages, date_from, date_to, mode):
+        received = 0
+        changed = 0
+        async for batch in iter_pages(date_from, date_to):
+            received += len(batch)
+            changed += await self.upsert_orders(batch)
+        logging.info(f"🔄 Синхронизация заказов ({mode}): получено {received}, изменено {changed}")
+        return changed
@@ -0,0 +1,165 @@
+# Файл: services/report_cache.py
+import os
+import time
+import zlib
+import pickle
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime
+
+# Сколько живет готовый отчет (секунды)
+PAST_TTL = int(os.getenv("REPORT_CACHE_PAST_TTL", 6 * 3600))   # прошедшие (закрытые) дни
+TODAY_TTL = int(os.getenv("REPORT_CACHE_TODAY_TTL", 60))       # если в периоде есть сегодня
+MAX_ENTRIES = int(os.getenv("REPORT_CACHE_SIZE", 64))
+# Снимок кэша на диске: переживает рестарт/засыпание инстанса на Render
+SNAPSHOT_PATH = os.getenv("REPORT_CACHE_SNAPSHOT", "report_cache.snapshot")
+
+
+def report_ttl(date_end):
+    """Закрытые дни почти не меняются - держим долго, текущий день - коротко."""
+    return PAST_TTL if date_end < datetime.now().date() else TODAY_TTL
+
+
+class ReportCache:
+    """
+    Кэш готовых отчетов по ключу (date_start, date_end, status).
+    Одинаковые одновременные запросы не запускают второй обход CRM+НП,
+    а ждут уже идущее вычисление (single-flight).
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._inflight = {}            # key -> asyncio.Task
+        self._waiters = {}             # key -> сколько запросов ждут вычисление
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def make_key(date_start, date_end, status):
+        return (date_start, date_end, (status or "").strip().lower())
+
+    def _get_fresh(self, key):
+        entry = self._entries.get(key)
+        if not entry:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _put(self, key, value, ttl):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_or_compute(self, key, compute, ttl):
+        """
+        compute - корутинная функция без аргументов.
+        Ошибки не кэшируются и достаются всем, кто ждал это вычисление.
+        """
+        entry = self._get_fresh(key)
+        if entry:
+            self.hits += 1
+            return entry[1]
+
+        task = self._inflight.get(key)
+        if task:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.create_task(self._run(key, compute, ttl))
+            self._inflight[key] = task
+
+        # shield: если один из ждущих ушел, общее вычисление не отменяется.
+        # Но если ушли ВСЕ ждущие - отменяем его, чтобы освободить HTTP-запросы
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._waiters.get(key) == 1 and not task.done():
+                task.cancel()
+            raise
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+
+    async def _run(self, key, compute, ttl):
+        try:
+            value = await compute()
+            self._put(key, value, ttl)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    def discard(self, key):
+        """Убрать один отчет (например, собранный из неполных данных)."""
+        self._entries.pop(key, None)
+
+    def invalidate(self, date_obj=None):
+        """Сбросить отчеты, в период которых попадает date_obj (или весь кэш)."""
+        if date_obj is None:
+            self._entries.clear()
+            return
+        for key in [k for k in self._entries if k[0] <= date_obj <= k[1]]:
+            del self._entries[key]
+
+    def stats(self):
+        total = self.hits + self.misses + self.coalesced
+        hit_rate = (self.hits + self.coalesced) / total * 100 if total else 0.0
+        return {
+            'entries': len(self._entries),
+            'inflight': len(self._inflight),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'hit_rate': round(hit_rate, 1),
+        }
+
+    # --- СНИМОК НА ДИСКЕ ---
+
+    def save_snapshot(self, path=SNAPSHOT_PATH):
+        """
+        Пишет живые записи в сжатый файл (атомарно, через временный файл).
+        Срок жизни храним в часах стены: monotonic после рестарта начинается заново.
+        """
+        now_mono, now_wall = time.monotonic(), time.time()
+        entries = [
+            (key, now_wall + expires_at - now_mono, value)
+            for key, (expires_at, value) in self._entries.items()
+            if expires_at > now_mono
+        ]
+        tmp = path + ".tmp"
+        with open(tmp, 'wb') as f:
+            f.write(zlib.compress(pickle.dumps(entries, protocol=pickle.HIGHEST_PROTOCOL)))
+        os.replace(tmp, path)
+        return len(entries)
+
+    def load_snapshot(self, path=SNAPSHOT_PATH):
+        """Поднимает записи из снимка (просроченные пропускает). Возвращает сколько поднято."""
+        if not os.path.exists(path):
+            return 0
+        try:
+            with open(path, 'rb') as f:
+                entries = pickle.loads(zlib.decompress(f.read()))
+        except Exception as e:
+            logging.warning(f"Снимок кэша отчетов не прочитан: {e!r}")
+            return 0
+        now_wall = time.time()
+        restored = 0
+        for key, expires_wall, value in entries:
+            ttl = expires_wall - now_wall
+            # Свежие отчеты, посчитанные после старта, не перетираем
+            if ttl > 0 and key not in self._entries:
+                self._put(key, value, ttl)
+                restored += 1
+        return restored
+
+    def log_stats(self):
+        logging.info(f"🗃 Кэш отчетов: {self.stats()}")
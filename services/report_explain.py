@@ -0,0 +1,273 @@
+# Файл: services/report_explain.py
+"""
+Разбор отчета за день без CRM и НП: почему заказ попал (или не попал) в отчет.
+
+Все читается из локальных таблиц bot_stats.db по индексам:
+- зеркало заказов (orders): статус + updatedAt, completedAt, ТТН, номер заказа;
+- кэш ТТН (ttn_cache): дата скана НП;
+- архив отправок и сводки: откуда отчет взял бы этот день.
+Правила те же, что у отчета: SitniksAPI.match_event и окно SitniksAPI.fetch_window.
+"""
+import os
+from datetime import datetime, timedelta
+from collections import Counter
+
+from .db import get_db, get_saved_ids_for_date, get_rollup_orders, iso_day
+from .report_planner import plan_days, ARCHIVE, ROLLUP, SOURCE_LABELS
+
+# Сколько дней вокруг даты события считаем "почти попал"
+NEAR_DAYS = int(os.getenv("EXPLAIN_NEAR_DAYS", 3))
+
+COLUMNS = "o.order_number, o.status_title, o.created_at, o.updated_at, o.completed_at, o.ttn"
+SCAN_COLUMNS = COLUMNS + ", t.ship_date, t.resolved, t.checked_at"
+
+
+def _to_date(dt_str):
+    return datetime.fromisoformat(dt_str.replace('Z', '')).date() if dt_str else None
+
+
+def _number_key(number):
+    # Номера заказов - строки: "10" после "9"
+    return len(number or ""), number or ""
+
+
+def _order(row):
+    """Строка зеркала -> заказ с полями, которые читает match_event, + скан НП из кэша."""
+    number, status, created, updated, completed, ttn = row[:6]
+    order = {
+        'orderNumber': number,
+        'status': {'title': status or ''},
+        'createdAt': created,
+        'updatedAt': updated,
+        'completedAt': completed,
+        'ttn': ttn,
+    }
+    if len(row) > 6 and row[7] is not None:
+        order['_scan'] = (row[6], bool(row[7]), row[8])
+    return order
+
+
+# === ЗАПРОСЫ (курсор первым аргументом, выполняются в пуле AsyncDB) ===
+
+def _mirror_state(c):
+    c.execute("SELECT key, value FROM sync_state")
+    state = dict(c.fetchall())
+    # MIN по индексу created_at - без прохода по таблице
+    c.execute("SELECT MIN(created_at) FROM orders")
+    state['first_created'] = c.fetchone()[0]
+    return state
+
+
+def _status_titles(c):
+    c.execute("SELECT DISTINCT status_title FROM orders")
+    return [row[0] for row in c.fetchall() if row[0]]
+
+
+def _status_rows(c, titles, date_from, date_to):
+    """Заказы в статусах titles, измененные в [date_from, date_to) (индекс status_title, updated_at)."""
+    if not titles:
+        return []
+    marks = ",".join("?" * len(titles))
+    c.execute(f'''
+        SELECT {SCAN_COLUMNS} FROM orders o LEFT JOIN ttn_cache t ON t.ttn = o.ttn
+        WHERE o.status_title IN ({marks}) AND o.updated_at >= ? AND o.updated_at < ?
+    ''', (*titles, date_from, date_to))
+    return c.fetchall()
+
+
+def _completed_rows(c, date_from, date_to):
+    c.execute(f'''
+        SELECT {SCAN_COLUMNS} FROM orders o LEFT JOIN ttn_cache t ON t.ttn = o.ttn
+        WHERE o.completed_at >= ? AND o.completed_at < ?
+    ''', (date_from, date_to))
+    return c.fetchall()
+
+
+def _updated_rows(c, date_from, date_to):
+    c.execute(f'''
+        SELECT {SCAN_COLUMNS} FROM orders o LEFT JOIN ttn_cache t ON t.ttn = o.ttn
+        WHERE o.updated_at >= ? AND o.updated_at < ?
+    ''', (date_from, date_to))
+    return c.fetchall()
+
+
+def _scanned_rows(c, date_from, date_to):
+    """Заказы, чьи ТТН НП отсканировала в [date_from, date_to] (индексы ship_date и orders.ttn)."""
+    c.execute(f'''
+        SELECT {SCAN_COLUMNS} FROM ttn_cache t JOIN orders o ON o.ttn = t.ttn
+        WHERE t.ship_date >= ? AND t.ship_date <= ?
+    ''', (date_from, date_to))
+    return c.fetchall()
+
+
+def _unscanned_rows(c, created_from, created_to):
+    """Заказы окна с ТТН, по которым в кэше нет даты скана."""
+    c.execute(f'''
+        SELECT {SCAN_COLUMNS} FROM orders o LEFT JOIN ttn_cache t ON t.ttn = o.ttn
+        WHERE o.created_at >= ? AND o.created_at < ? AND o.ttn IS NOT NULL AND o.ttn != ''
+          AND (t.ttn IS NULL OR t.ship_date IS NULL)
+    ''', (created_from, created_to))
+    return c.fetchall()
+
+
+def _number_rows(c, numbers):
+    rows = []
+    for number in numbers:
+        c.execute(f'''
+            SELECT {SCAN_COLUMNS} FROM orders o LEFT JOIN ttn_cache t ON t.ttn = o.ttn
+            WHERE o.order_number = ?
+        ''', (str(number),))
+        rows.extend(c.fetchall())
+    return rows
+
+
+# === ПРАВИЛА ===
+
+def _target(status):
+    target = (status or "").strip().lower()
+    return None if target in ("", "всі") else target
+
+
+def _in_window(order, window):
+    """То же условие, что OrderStore.iter_orders для окна fetch_window."""
+    created = _to_date(order['createdAt'])
+    return bool(created) and window[0] <= created <= window[1]
+
+
+def _rule(order, target):
+    if target and "виконано" in target:
+        return "completedAt" if order['completedAt'] else "updatedAt (Виконано без completedAt)"
+    return "updatedAt" if order['updatedAt'] else "createdAt"
+
+
+def verdict(crm, order, day, target, window):
+    """
+    (попал в отчет?, правило/причина) для одного заказа из зеркала.
+    Повторяет ветки get_report_orders: "Відправлено" - по скану НП, остальные - match_event.
+    """
+    if target and "відправлено" in target:
+        if not order['ttn']:
+            return False, "нет ТТН - дату отправки не узнать"
+        scan = order.get('_scan')
+        if scan is None:
+            return False, "ТТН нет в кэше - live-отчет спросит НП"
+        ship_date, resolved, checked_at = scan
+        if not ship_date and resolved:
+            return False, "НП не засчитала скан (ТТН-призрак: скан намного позже создания)"
+        if not ship_date:
+            return False, f"НП еще не отсканировала (проверено {checked_at[:16].replace('T', ' ')})"
+        ship_date = datetime.strptime(ship_date, "%Y-%m-%d").date()
+        if ship_date != day:
+            return False, f"скан НП {ship_date.strftime('%d.%m')}"
+        if not _in_window(order, window):
+            return False, f"скан НП {day.strftime('%d.%m')}, но заказ создан раньше окна выборки"
+        return True, f"скан НП {day.strftime('%d.%m')}"
+
+    match = crm.match_event(order, target)
+    if not match:
+        if target and "виконано" in target:
+            return False, "нет completedAt, статус не Виконано"
+        return False, f"статус '{order['status']['title']}'"
+    event_date, _ = match
+    rule = _rule(order, target)
+    if event_date != day:
+        return False, f"{rule} {event_date.strftime('%d.%m')}"
+    if not _in_window(order, window):
+        return False, f"{rule} {day.strftime('%d.%m')}, но заказ создан раньше окна выборки"
+    return True, f"{rule} {day.strftime('%d.%m')}"
+
+
+# === РАЗБОР ===
+
+async def _candidates(day, target, window):
+    """Заказы-кандидаты: совпавшие и близкие к дате события (±NEAR_DAYS)."""
+    db = get_db()
+    near_from = iso_day(day - timedelta(days=NEAR_DAYS))
+    near_to = iso_day(day + timedelta(days=NEAR_DAYS + 1))
+
+    if target and "відправлено" in target:
+        rows = await db.read(_scanned_rows, near_from, iso_day(day + timedelta(days=NEAR_DAYS)))
+        rows += await db.read(_unscanned_rows, iso_day(window[0]), iso_day(day + timedelta(days=1)))
+        return rows
+
+    if not target:
+        return await db.read(_updated_rows, near_from, near_to)
+
+    titles = [t for t in await db.read(_status_titles) if target in t.lower()]
+    if "виконано" in target:
+        rows = await db.read(_completed_rows, near_from, near_to)
+        # Закрытые без completedAt - по updatedAt
+        return rows + await db.read(_status_rows, titles, near_from, near_to)
+    return await db.read(_status_rows, titles, near_from, near_to)
+
+
+async def _saved_numbers(day, status, source):
+    """Номера заказов, которые отчет возьмет из архива/сводок (None - день live)."""
+    if source == ARCHIVE:
+        return set(await get_saved_ids_for_date(day) or [])
+    if source == ROLLUP:
+        return {str(o.get('orderNumber') or o.get('id')) for o in await get_rollup_orders(day, day, status)}
+    return None
+
+
+async def explain(crm, day, status, order_number=None):
+    """
+    Разбор отчета "status" за день day по локальным данным (без CRM и НП).
+    order_number - разобрать один заказ. Возвращает dict для formatter.format_explain_report.
+    """
+    target = _target(status)
+    window = crm.fetch_window(day, day, status)
+    source = (await plan_days(day, day, status))[day]
+    saved = await _saved_numbers(day, status, source)
+
+    result = {
+        'day': day,
+        'status': status,
+        'window': window,
+        'source': SOURCE_LABELS[source],
+        'saved': saved,
+        'mirror': await get_db().read(_mirror_state),
+    }
+
+    if order_number:
+        rows = await get_db().read(_number_rows, [order_number])
+        orders = [_order(r) for r in rows]
+        result['order'] = [(o, *verdict(crm, o, day, target, window)) for o in orders]
+        result['order_number'] = str(order_number)
+        return result
+
+    seen = {}
+    for row in await _candidates(day, target, window):
+        order = _order(row)
+        seen.setdefault(order['orderNumber'], order)
+
+    matches, near = [], []
+    for order in seen.values():
+        included, reason = verdict(crm, order, day, target, window)
+        (matches if included else near).append((order, reason))
+    matches.sort(key=lambda x: _number_key(x[0]['orderNumber']))
+    near.sort(key=lambda x: _number_key(x[0]['orderNumber']))
+    result['matches'] = matches
+    result['near'] = near
+
+    # Изменены в этот день, но статус уже другой (ушли дальше по воронке)
+    if target and "відправлено" not in target:
+        day_rows = await get_db().read(_updated_rows, iso_day(day), iso_day(day + timedelta(days=1)))
+        result['moved_on'] = Counter(
+            (r[1] or "Без статуса") for r in day_rows if target not in (r[1] or "").lower()
+        ).most_common()
+    else:
+        result['moved_on'] = []
+
+    # Архив/сводки против зеркала: у кого расходится и почему
+    if saved is not None:
+        matched = {o['orderNumber'] for o, _ in matches}
+        only_saved = sorted(saved - matched, key=_number_key)
+        rows = await get_db().read(_number_rows, only_saved)
+        found = {r[0]: _order(r) for r in rows}
+        result['only_saved'] = [
+            (number, verdict(crm, found[number], day, target, window)[1] if number in found else "нет в зеркале")
+            for number in only_saved
+        ]
+        result['only_mirror'] = sorted(matched - saved, key=_number_key)
+    return result
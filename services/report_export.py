@@ -0,0 +1,78 @@
+# Файл: services/report_export.py
+"""
+Выгрузка отчета файлом (CSV или XLSX) для бухгалтерии.
+Строки пишутся в файл по одной, весь текст/таблица в памяти не собирается.
+"""
+import os
+import csv
+import tempfile
+from openpyxl import Workbook
+
+from .db import order_ttn
+
+HEADER = ["№ заказа", "Клиент", "Товары", "Сумма, грн", "ТТН", "Дата события", "Статус CRM"]
+FORMATS = ("csv", "xlsx")
+
+
+def export_rows(orders):
+    """Строки выгрузки по одной (генератор). Дата события - date или None."""
+    for order in orders:
+        client = order.get('client') or {}
+        products = order.get('products') or []
+        confirmed = order.get('_confirmed_date')
+        yield [
+            str(order.get('orderNumber') or order.get('id') or ""),
+            client.get('fullname', ''),
+            ", ".join(p.get('title', 'Без названия') for p in products),
+            float(order.get('totalPrice', 0) or 0),
+            order_ttn(order) or "",
+            confirmed,
+            (order.get('status') or {}).get('title', ''),
+        ]
+
+
+def _write_csv(orders, path):
+    # BOM и ";" - чтобы Excel с украинской локалью открыл файл без мастера импорта
+    with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.writer(f, delimiter=';')
+        writer.writerow(HEADER)
+        for row in export_rows(orders):
+            row[5] = row[5].strftime('%d.%m.%Y') if row[5] else ""
+            writer.writerow(row)
+
+
+def _write_xlsx(orders, path, title):
+    # write_only: строки сразу уходят в поток, а не в дерево ячеек
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title=title[:31] or "Отчет")
+    ws.append(HEADER)
+    for row in export_rows(orders):
+        # Дата остается датой - в Excel по ней можно фильтровать и сортировать
+        ws.append(row)
+    wb.save(path)
+
+
+def export_report(orders, fmt, title="Отчет"):
+    """
+    Пишет отчет во временный файл и возвращает путь (удалить после отправки).
+    fmt - "csv" или "xlsx". Синхронная функция: из бота вызывать через asyncio.to_thread.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+
+    fd, path = tempfile.mkstemp(prefix="report_", suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        if fmt == "csv":
+            _write_csv(orders, path)
+        else:
+            _write_xlsx(orders, path, title)
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
+
+def export_filename(status, period_str, fmt):
+    safe_status = "_".join((status or "all").lower().split())
+    return f"report_{safe_status}_{period_str}.{fmt}"
@@ -0,0 +1,74 @@
+# Файл: services/report_jobs.py
+import os
+import asyncio
+import logging
+from contextvars import ContextVar
+
+# Сколько отчетов считаем одновременно на весь бот (на пользователя - один)
+MAX_CONCURRENT_JOBS = int(os.getenv("REPORT_JOBS_MAX", 4))
+
+_current_progress = ContextVar("report_progress", default=None)
+
+
+class Progress:
+    """Счетчики прогресса отчета (страницы CRM, заказы, ТТН)."""
+
+    def __init__(self):
+        self.pages = 0
+        self.orders = 0
+        self.ttns = 0
+
+    def text(self):
+        parts = [f"📥 страниц CRM: {self.pages}"]
+        if self.orders:
+            parts.append(f"🧾 заказов: {self.orders}")
+        if self.ttns:
+            parts.append(f"🚚 ТТН: {self.ttns}")
+        return " | ".join(parts)
+
+
+def track(field, n=1):
+    """Отметить прогресс текущего отчета (если код выполняется внутри отчета)."""
+    progress = _current_progress.get()
+    if progress is not None:
+        setattr(progress, field, getattr(progress, field) + n)
+
+
+class ReportJobs:
+    """
+    Отчеты выполняются фоновыми задачами.
+    У пользователя максимум один отчет: новый запрос или "Отмена" отменяют предыдущий.
+    """
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT_JOBS):
+        self._sem = asyncio.Semaphore(max_concurrent)
+        self._jobs = {}  # user_id -> asyncio.Task
+
+    def start(self, user_id, job, progress):
+        """job - корутина отчета, progress - его Progress."""
+        self.cancel(user_id)
+        task = asyncio.create_task(self._run(job, progress))
+        self._jobs[user_id] = task
+        task.add_done_callback(lambda t: self._forget(user_id, t))
+        # Отменили еще до старта - корутину закрываем, чтобы не висела
+        task.add_done_callback(lambda t: job.close())
+        return task
+
+    async def _run(self, job, progress):
+        _current_progress.set(progress)
+        async with self._sem:
+            return await job
+
+    def _forget(self, user_id, task):
+        if self._jobs.get(user_id) is task:
+            del self._jobs[user_id]
+        if not task.cancelled() and task.exception():
+            logging.error(f"Отчет пользователя {user_id} упал: {task.exception()!r}")
+
+    def cancel(self, user_id):
+        """Отменяет отчет пользователя. True - было что отменять."""
+        task = self._jobs.pop(user_id, None)
+        if task and not task.done():
+            task.cancel()
+            return True
+        return False
@@ -0,0 +1,163 @@
+# Файл: services/report_planner.py
+import time
+import logging
+from datetime import datetime, timedelta
+
+from .metrics import REPORT_SECONDS, REPORTS_INCOMPLETE
+from .resilience import track_gaps
+from .crm_api import CRMFetchError
+from .db import (
+    get_archived_dates, get_archived_orders, get_rolled_up_dates, get_rollup_orders, restore_snapshots
+)
+
+ARCHIVE = "archive"
+ROLLUP = "rollup"
+LIVE = "live"
+
+SOURCE_LABELS = {
+    ARCHIVE: "💾 Архив",
+    ROLLUP: "📊 Сводки",
+    LIVE: "🌐 Live",
+}
+
+
+def day_range(d_start, d_end):
+    """Все дни с d_start по d_end включительно."""
+    return [d_start + timedelta(days=i) for i in range((d_end - d_start).days + 1)]
+
+
+def _runs(days):
+    """Склеивает отсортированные даты в непрерывные отрезки [(start, end), ...]."""
+    runs = []
+    for day in days:
+        if runs and runs[-1][1] + timedelta(days=1) == day:
+            runs[-1][1] = day
+        else:
+            runs.append([day, day])
+    return [tuple(r) for r in runs]
+
+
+def _live_segments(crm, live_days, status):
+    """
+    Отрезки недостающих дней, каждый со своим окном CRM (окно считает fetch_window).
+    Соседние отрезки склеиваем, только если их окна CRM пересекаются: тогда один проход
+    по объединенному окну дешевле двух. Иначе - один недостающий день в начале периода
+    плюс сегодня тянули бы из CRM весь период.
+    """
+    segments = []
+    for start, end in _runs(live_days):
+        if segments and crm.fetch_window(start, end, status)[0] <= segments[-1][1]:
+            segments[-1][1] = end
+        else:
+            segments.append([start, end])
+    return [tuple(s) for s in segments]
+
+
+async def plan_days(d_start, d_end, status):
+    """
+    Для каждого дня периода решает, откуда брать данные:
+    архив отправок -> дневные сводки -> live (CRM+НП).
+    Сегодняшний день всегда live - он еще не закончился.
+    """
+    today = datetime.now().date()
+    shipped = "відправлено" in status.lower()
+    archived = await get_archived_dates(d_start, d_end) if shipped else set()
+    rolled = await get_rolled_up_dates(d_start, d_end, status)
+
+    plan = {}
+    for day in day_range(d_start, d_end):
+        if day >= today:
+            plan[day] = LIVE
+        elif day in archived:
+            plan[day] = ARCHIVE
+        elif day in rolled:
+            plan[day] = ROLLUP
+        else:
+            plan[day] = LIVE
+    return plan
+
+
+def describe_plan(plan):
+    """Строка для отчета: какие дни откуда взяты."""
+    parts = []
+    for source in (ARCHIVE, ROLLUP, LIVE):
+        days = sorted(d for d, s in plan.items() if s == source)
+        if not days:
+            continue
+        ranges = []
+        for start, end in _runs(days):
+            ranges.append(start.strftime('%d.%m') if start == end
+                          else f"{start.strftime('%d.%m')}-{end.strftime('%d.%m')}")
+        parts.append(f"{SOURCE_LABELS[source]}: {', '.join(ranges)}")
+    return "_" + " | ".join(parts) + "_\n"
+
+
+async def _archived_day(crm, day, gaps):
+    """
+    Заказы дня из архива. Строки, перенесенные из старой схемы без снимка
+    (только номер заказа), один раз подтягиваем из CRM и дописываем в архив.
+    Не найденные в CRM получают снимок из колонок архива - повторно их не ищем.
+    """
+    orders = await get_archived_orders(day) or []
+    missing = [str(o['orderNumber']) for o in orders if o.get('_no_snapshot')]
+    if not missing:
+        return orders
+
+    try:
+        fetched = await crm.get_orders_by_specific_ids(day, missing)
+    except CRMFetchError as e:
+        logging.error(f"Архив {day}: заказы без снимка не подтянуты из CRM: {e}")
+        gaps.append(f"архив за {day.strftime('%d.%m')}: {len(missing)} заказов без данных (CRM не ответила)")
+        return orders
+    by_number = {str(o.get('orderNumber') or o.get('id')): o for o in fetched}
+    # Кого CRM не вернула (удален, создан раньше окна) - сохраняем снимок из колонок архива,
+    # иначе каждое чтение дня снова проходило бы окно CRM ради тех же заказов
+    lost = [o for o in orders if o.get('_no_snapshot') and str(o['orderNumber']) not in by_number]
+    if lost:
+        logging.warning(f"Архив {day}: {len(lost)} заказов нет в CRM - оставляю данные из архива")
+    await restore_snapshots(day, fetched + lost)
+    return [by_number.get(str(o['orderNumber']), o) for o in orders]
+
+
+async def build_report(crm, d_start, d_end, status):
+    """
+    Собирает заказы периода по дням: сохраненные дни - из БД,
+    недостающие - live (окно CRM - только под недостающие дни).
+    Возвращает (orders, source_msg, gaps). gaps - причины неполноты live-данных
+    (НП ответила не по всем ТТН и т.п.), пустой список - отчет полный.
+    """
+    started = time.perf_counter()
+    plan = await plan_days(d_start, d_end, status)
+    orders = []
+    archive_gaps = []
+
+    for start, end in _runs(sorted(d for d, s in plan.items() if s == ARCHIVE)):
+        for day in day_range(start, end):
+            orders.extend(await _archived_day(crm, day, archive_gaps))
+
+    for start, end in _runs(sorted(d for d, s in plan.items() if s == ROLLUP)):
+        orders.extend(await get_rollup_orders(start, end, status))
+
+    gaps = []
+    live_days = sorted(d for d, s in plan.items() if s == LIVE)
+    live_set = set(live_days)
+    with track_gaps() as gaps:
+        for start, end in _live_segments(crm, live_days, status):
+            live_orders = await crm.get_report_orders(start, end, status_filter=status)
+            # Дни между недостающими уже взяты из БД - их из live не дублируем
+            orders.extend(o for o in live_orders if o.get('_confirmed_date') in live_set)
+
+    logging.info(f"🧭 План отчета {d_start}..{d_end} '{status}': "
+                 f"{ {s: sum(1 for v in plan.values() if v == s) for s in (ARCHIVE, ROLLUP, LIVE)} }")
+
+    orders.sort(key=lambda x: x.get('_confirmed_date') or datetime.min.date())
+
+    sources = set(plan.values())
+    source = sources.pop() if len(sources) == 1 else "mixed"
+    REPORT_SECONDS.observe(time.perf_counter() - started, status=status.strip().lower(), source=source)
+    source_msg = describe_plan(plan)
+    gaps = archive_gaps + gaps
+    if gaps:
+        REPORTS_INCOMPLETE.inc(status=status.strip().lower())
+        source_msg += "⚠️ *Отчет неполный:* " + "; ".join(gaps) + ". Повторите позже.\n"
+    return orders, source_msg, gaps
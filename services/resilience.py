@@ -0,0 +1,165 @@
+# Файл: services/resilience.py
+"""
+Общие кирпичики устойчивости для клиентов CRM и НП:
+- паузы между повторами с экспоненциальным ростом и случайным разбросом (full jitter);
+- разбор заголовка Retry-After;
+- AdaptiveLimit: параллельность/скорость, которая проседает при троттлинге и медленно восстанавливается;
+- CircuitBreaker на эндпоинт: после серии ошибок перестаем долбить лежащий сервис;
+- учет "дыр" в данных текущего отчета (track_gaps / note_gap).
+"""
+import os
+import time
+import random
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from .metrics import BREAKER_OPENED
+
+BACKOFF_BASE = float(os.getenv("RETRY_BACKOFF_BASE", 0.5))
+BACKOFF_CAP = float(os.getenv("RETRY_BACKOFF_CAP", 30))
+# Сколько ошибок подряд открывают breaker и сколько он остается открытым (сек)
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", 8))
+BREAKER_RESET = float(os.getenv("BREAKER_RESET_SECONDS", 60))
+
+# Ответы, которые имеет смысл повторить (остальные 4xx повтор не исправит)
+RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """Пауза перед повтором attempt (с 1): случайная от 0 до base * 2^(attempt-1), не больше cap."""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+def retry_after(headers, cap=BACKOFF_CAP):
+    """Retry-After в секундах (число или HTTP-дата) или None."""
+    value = headers.get('Retry-After') if headers else None
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), cap)
+
+
+def is_throttle(status, headers=None):
+    """Сервис просит сбавить темп: 429 или 503 с Retry-After (503 без него - скорее авария)."""
+    return status == 429 or (status == 503 and bool(headers and headers.get('Retry-After')))
+
+
+class AdaptiveLimit:
+    """
+    AIMD-лимит: троттлинг делит значение пополам, каждый успех прибавляет step.
+    Для CRM это размер волны страниц, для ключа НП - запросов в секунду.
+    """
+
+    def __init__(self, maximum, minimum=1, step=0.25):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.step = step
+        self.value = maximum
+
+    def on_throttle(self):
+        self.value = max(self.minimum, self.value / 2)
+
+    def on_success(self):
+        self.value = min(self.maximum, self.value + self.step)
+
+    def current(self):
+        return max(1, int(self.value))
+
+
+class CircuitBreaker:
+    """
+    closed: запросы идут, ошибки подряд считаются.
+    open: после threshold ошибок подряд запросы не делаем reset_timeout секунд.
+    half-open: потом пропускаем одну пробу; успех закрывает breaker, ошибка - снова open.
+    """
+
+    def __init__(self, name, threshold=BREAKER_FAILURES, reset_timeout=BREAKER_RESET):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probe_at = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "open":
+            return False
+        # half-open: одна проба за reset_timeout (зависшая проба не блокирует навсегда)
+        now = time.monotonic()
+        if self.probe_at is None or now - self.probe_at >= self.reset_timeout:
+            self.probe_at = now
+            return True
+        return False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logging.info(f"🟢 {self.name}: сервис снова отвечает, breaker закрыт")
+        self.failures = 0
+        self.opened_at = None
+        self.probe_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probe_at is not None or (self.opened_at is None and self.failures >= self.threshold):
+            if self.opened_at is None:
+                logging.error(f"🔴 {self.name}: {self.failures} ошибок подряд, "
+                              f"пауза запросов на {self.reset_timeout:.0f} c")
+                BREAKER_OPENED.inc(endpoint=self.name)
+            self.opened_at = time.monotonic()
+            self.probe_at = None
+
+
+# Breaker'ы общие на процесс: SitniksAPI создается в нескольких местах
+_breakers = {}
+
+
+def get_breaker(name):
+    if name not in _breakers:
+        _breakers[name] = CircuitBreaker(name)
+    return _breakers[name]
+
+
+# === НЕПОЛНЫЕ ДАННЫЕ ===
+_gaps = ContextVar("data_gaps", default=None)
+
+
+@contextmanager
+def track_gaps():
+    """
+    with track_gaps() as gaps: ... - собирает причины, по которым данные неполные.
+    Пустой список в конце = данные полные.
+    """
+    gaps = []
+    token = _gaps.set(gaps)
+    try:
+        yield gaps
+    finally:
+        _gaps.reset(token)
+
+
+def note_gap(reason):
+    """Клиент не смог получить часть данных (но вернул остальное)."""
+    logging.warning(f"⚠️ Неполные данные: {reason}")
+    gaps = _gaps.get()
+    if gaps is not None:
+        gaps.append(reason)
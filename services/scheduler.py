@@ -1,50 +1,214 @@
+import os
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta, time
+import pytz
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 
 # Импортируем сервисы
-from services.crm_api import SitniksAPI
-from services.db import save_daily_stats
+from services.crm_api import REPORT_STATUSES, STATUS_MARGIN_DAYS
+from services.metrics import instrument_job
+from services.report_planner import day_range
+from services.resilience import track_gaps
+from services.db import (
+    save_daily_stats_bulk, save_daily_rollups, get_saved_ids_for_date, get_archived_dates,
+    get_provisional_dates, get_archived_order_numbers, update_shipment_statuses
+)
 
-async def collect_daily_data(bot):
+# Фоновая сверка статусов архива с CRM (0 = выключена)
+ARCHIVE_REFRESH_HOURS = int(os.getenv("ARCHIVE_REFRESH_HOURS", 0))
+ARCHIVE_REFRESH_DAYS = int(os.getenv("ARCHIVE_REFRESH_DAYS", 14))
+# Инкрементальный сбор отправок в течение дня (минуты, 0 = только в 23:50)
+COLLECT_INTERVAL_MINUTES = int(os.getenv("COLLECT_INTERVAL_MINUTES", 60))
+# Сверка поздних сканов НП: сколько закрытых дней и как часто (часы, 0 = выключена)
+RECONCILE_DAYS = int(os.getenv("RECONCILE_DAYS", 7))
+RECONCILE_HOURS = int(os.getenv("RECONCILE_HOURS", 6))
+# Насколько назад на старте ищем пропущенные дни (0 = не искать)
+BACKFILL_DAYS = int(os.getenv("BACKFILL_DAYS", 14))
+# Через сколько минут после старта догружать пропуски: первые отчеты после
+# пробуждения не должны ждать длинный проход CRM (он держит лок зеркала заказов)
+BACKFILL_DELAY_MINUTES = int(os.getenv("BACKFILL_DELAY_MINUTES", 15))
+# Закрывающий проход дня (23:50): промежуточный сбор в это время не запускаем
+CLOSING_TIME = time(23, 50)
+
+async def save_shipments(crm, date_from, date_to, on_change=None, provisional=False, sync=True):
+    """
+    Пересчитывает отправки за date_from..date_to (CRM из зеркала + НП из кэша,
+    у НП спрашиваем только еще не отсканированные ТТН) и переписывает в архиве
+    только дни, где состав заказов изменился.
+    provisional=True - день еще не закончился (сбор внутри дня), пишем его промежуточным.
+    Закрывающий проход переписывает промежуточные дни, даже если состав не изменился.
+    sync=False - окно CRM уже синхронизировано вызывающим (crm.sync_orders).
+    Возвращает {день: заказы} или None, если данные неполные (тогда ничего не пишем).
+    """
+    with track_gaps() as gaps:
+        orders = await crm.get_report_orders(date_from, date_to, status_filter="Відправлено", sync=sync)
+    if gaps:
+        # Неполный день в архив не пишем: он останется live, пока его не соберут целиком
+        logging.error(f"❌ Отправки {date_from}..{date_to} не сохранены, данные неполные: {'; '.join(gaps)}")
+        return None
+
+    by_day = {day: [] for day in day_range(date_from, date_to)}
+    for order in orders:
+        by_day.setdefault(order['_confirmed_date'], []).append(order)
+
+    unclosed = set() if provisional else await get_provisional_dates(date_from, date_to)
+    changed = []
+    for day, day_orders in by_day.items():
+        saved = await get_saved_ids_for_date(day)
+        fresh = sorted(str(o.get('orderNumber') or o.get('id')) for o in day_orders)
+        if saved is None or sorted(saved) != fresh or day in unclosed:
+            changed.append((day, day_orders))
+    if changed:
+        await save_daily_stats_bulk(changed, provisional=provisional)
+        if on_change:
+            for day, _ in changed:
+                on_change(day)
+    logging.info(f"🚚 Отправки {date_from}..{date_to}: изменились дни {[str(d) for d, _ in changed]}")
+    return by_day
+
+@instrument_job("collect_daily_data")
+async def collect_daily_data(bot, get_crm, on_change=None):
     """
     Запускается каждый вечер.
     1. Скачивает данные через НП (максимальная точность).
     2. Сохраняет в локальную базу данных.
+    3. Считает дневные сводки по каждому статусу.
     Сообщений НЕ шлет.
     """
     logging.info("🕵️ Начинаю сбор ежедневной статистики...")
-    crm = SitniksAPI()
+    crm = get_crm()
     today = datetime.now().date()
-    
+
+    # CRM проходим один раз - самым широким окном из всех статусов,
+    # дальше и отправки, и сводки считаются только по зеркалу
+    await crm.sync_orders(min(crm.fetch_window(today, today, s)[0] for s in REPORT_STATUSES), today)
+
     # Фильтруем только ОТПРАВКИ (это самое важное для учета)
     # Используем нашу умную логику с проверкой API Новой Почты
-    orders = await crm.get_report_orders(today, today, status_filter="Відправлено")
-    
-    if orders:
-        count = len(orders)
-        # Считаем сумму, учитывая возможные ошибки в данных (float)
-        total_sum = sum(float(o.get('totalPrice', 0)) for o in orders)
-        
-        # Собираем список ID заказов (чтобы знать, КТО именно уехал)
-        ids = [o.get('orderNumber') or o.get('id') for o in orders]
-        
-        # Сохраняем в БД
-        save_daily_stats(today, count, total_sum, ids)
-    else:
-        logging.info("🤷‍♂️ Сегодня отправок не найдено. Сохраняю нули.")
-        save_daily_stats(today, 0, 0.0, [])
-
-def setup_scheduler(bot):
+    shipped = await save_shipments(crm, today, today, on_change, sync=False)
+
+    orders_by_status = {}
+    if shipped is not None:
+        orders_by_status["Відправлено"] = shipped[today]
+
+    # Сводки по всем остальным статусам (зеркало уже свежее, НП в кэше - это быстро)
+    for status in REPORT_STATUSES:
+        if status == "Відправлено":
+            continue
+        orders_by_status[status] = await crm.get_report_orders(today, today, status_filter=status, sync=False)
+    await save_daily_rollups(today, orders_by_status)
+
+@instrument_job("collect_intraday")
+async def collect_intraday(bot, get_crm, on_change=None):
+    """
+    Проход в течение дня: заказы CRM + ТТН, которые еще не отсканированы.
+    День пишется промежуточным: отчеты за прошлые дни берут его из архива, только когда
+    его закроет проход в 23:50, сверка или догрузка пропусков на старте.
+    """
+    # Время - как у триггеров планировщика (Europe/Kyiv)
+    if datetime.now(pytz.timezone("Europe/Kyiv")).time() >= CLOSING_TIME:
+        # День уже закрывает collect_daily_data - не пишем его снова промежуточным
+        return
+    crm = get_crm()
+    today = datetime.now().date()
+    await save_shipments(crm, today, today, on_change, provisional=True)
+
+@instrument_job("reconcile_recent_days")
+async def reconcile_recent_days(bot, get_crm, on_change=None):
+    """
+    НП бывает сканирует посылку уже после полуночи (или после нашего сбора).
+    Пересчитываем последние RECONCILE_DAYS закрытых дней и патчим архив, если состав изменился.
+    """
+    crm = get_crm()
+    yesterday = datetime.now().date() - timedelta(days=1)
+    await save_shipments(crm, yesterday - timedelta(days=RECONCILE_DAYS - 1), yesterday, on_change)
+
+@instrument_job("backfill_missed_days")
+async def backfill_missed_days(bot, get_crm, on_change=None):
+    """
+    На старте: дни за последние BACKFILL_DAYS, которых нет в архиве или которые
+    остались промежуточными (бот был выключен или спал в 23:50), собираем одним проходом.
+    """
+    yesterday = datetime.now().date() - timedelta(days=1)
+    date_from = yesterday - timedelta(days=BACKFILL_DAYS - 1)
+    missed = sorted(set(day_range(date_from, yesterday)) - await get_archived_dates(date_from, yesterday))
+    if not missed:
+        logging.info("✅ Пропущенных дней в архиве нет")
+        return
+    logging.info(f"🩹 Пропущенные дни в архиве: {[str(d) for d in missed]} - догружаю")
+    crm = get_crm()
+    # Один проход от первого пропуска; уже собранные дни перепишутся, только если изменились
+    await save_shipments(crm, missed[0], missed[-1], on_change)
+
+@instrument_job("refresh_archive_statuses")
+async def refresh_archive_statuses(bot, get_crm):
+    """
+    Подтягивает свежие статусы CRM для заказов из архива за последние дни
+    (например, "Відправлено" -> "Виконано"). Берем их из локального зеркала
+    заказов, которое перед этим догружает изменения из CRM.
+    """
+    crm = get_crm()
+    today = datetime.now().date()
+    # Заказ из архива создан не раньше, чем за запас "Відправлено" до даты отправки
+    await crm.sync_orders(today - timedelta(days=ARCHIVE_REFRESH_DAYS + STATUS_MARGIN_DAYS["відправлено"]))
+
+    numbers = await get_archived_order_numbers(today - timedelta(days=ARCHIVE_REFRESH_DAYS), today)
+    changed = await update_shipment_statuses(await crm.store.get_statuses(numbers))
+    logging.info(f"🔁 Сверка архива с CRM: обновлено статусов {changed}")
+
+def setup_scheduler(bot, get_crm, on_archive_change=None):
+    """
+    get_crm() - общий на процесс клиент CRM (тот же, что у отчетов): одно зеркало заказов
+    с одним локом синхронизации и общие лимиты, а не свой клиент на каждый запуск задачи.
+    on_archive_change(day) - вызывается, когда день в архиве переписан (сброс кэша отчетов).
+    """
     scheduler = AsyncIOScheduler(timezone="Europe/Kyiv")
-    
+    job_kwargs = {'bot': bot, 'get_crm': get_crm, 'on_change': on_archive_change}
+
     # Ставим на 23:50 (надеюсь, ноут еще включен?)
     scheduler.add_job(
         collect_daily_data,
-        trigger=CronTrigger(hour=23, minute=50),
-        kwargs={'bot': bot}
+        trigger=CronTrigger(hour=CLOSING_TIME.hour, minute=CLOSING_TIME.minute),
+        kwargs=job_kwargs
     )
-    
+
+    if COLLECT_INTERVAL_MINUTES:
+        scheduler.add_job(
+            collect_intraday,
+            trigger='interval',
+            minutes=COLLECT_INTERVAL_MINUTES,
+            kwargs=job_kwargs,
+            max_instances=1,
+            coalesce=True
+        )
+
+    if RECONCILE_HOURS and RECONCILE_DAYS:
+        scheduler.add_job(
+            reconcile_recent_days,
+            trigger='interval',
+            hours=RECONCILE_HOURS,
+            kwargs=job_kwargs,
+            max_instances=1,
+            coalesce=True
+        )
+
+    if BACKFILL_DAYS:
+        # Один раз после старта, с задержкой - сначала отвечаем тем, кто разбудил инстанс
+        scheduler.add_job(
+            backfill_missed_days,
+            trigger='date',
+            run_date=datetime.now(pytz.timezone("Europe/Kyiv")) + timedelta(minutes=BACKFILL_DELAY_MINUTES),
+            kwargs=job_kwargs
+        )
+
+    if ARCHIVE_REFRESH_HOURS:
+        scheduler.add_job(
+            refresh_archive_statuses,
+            trigger='interval',
+            hours=ARCHIVE_REFRESH_HOURS,
+            kwargs={'bot': bot, 'get_crm': get_crm}
+        )
+
     scheduler.start()
-    logging.info("✅ Сборщик данных запущен (23:50 каждый день)")
\ No newline at end of file
+    logging.info("✅ Сборщик данных запущен (23:50 каждый день)")
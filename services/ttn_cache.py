@@ -0,0 +1,91 @@
+# Файл: services/ttn_cache.py
+import os
+import sqlite3
+from datetime import datetime, timedelta
+
+from .db import DB_NAME, get_db
+
+# Через сколько минут перепроверяем ТТН, которые НП еще не отсканировала (статус 1)
+PENDING_TTL_MINUTES = float(os.getenv("NP_PENDING_TTL_MINUTES", 30))
+# Сколько ТТН подставляем в один IN (...)
+LOOKUP_CHUNK = 500
+
+
+def _lookup(c, ttn_list, stale_before):
+    hits = {}
+    misses = []
+    found = {}
+    for i in range(0, len(ttn_list), LOOKUP_CHUNK):
+        chunk = ttn_list[i:i + LOOKUP_CHUNK]
+        c.execute(f'''
+            SELECT ttn, ship_date, resolved, checked_at FROM ttn_cache
+            WHERE ttn IN ({','.join('?' * len(chunk))})
+        ''', chunk)
+        found.update((row[0], row[1:]) for row in c.fetchall())
+
+    for ttn in ttn_list:
+        row = found.get(ttn)
+        if row is None:
+            misses.append(ttn)
+            continue
+        ship_date, resolved, checked_at = row
+        if resolved or datetime.fromisoformat(checked_at) > stale_before:
+            hits[ttn] = datetime.strptime(ship_date, "%Y-%m-%d").date() if ship_date else None
+        else:
+            misses.append(ttn)
+    return hits, misses
+
+
+def _store(c, rows):
+    c.executemany('''
+        INSERT OR REPLACE INTO ttn_cache (ttn, ship_date, resolved, checked_at)
+        VALUES (?, ?, ?, ?)
+    ''', rows)
+
+
+class TTNCache:
+    """
+    Постоянный кэш ТТН -> дата отправки (лежит в bot_stats.db).
+    Отсканированная посылка свою дату уже не меняет, поэтому такие ТТН храним навсегда.
+    Еще не отсканированные перепроверяем не чаще раза в PENDING_TTL_MINUTES.
+    Запросы идут через AsyncDB - вне event loop, пачками, а не по запросу на ТТН.
+    """
+
+    def __init__(self):
+        self._init_table()
+
+    def _init_table(self):
+        conn = sqlite3.connect(DB_NAME)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS ttn_cache (
+                ttn TEXT PRIMARY KEY,
+                ship_date TEXT,
+                resolved INTEGER,
+                checked_at TEXT
+            )
+        ''')
+        # Поиск посылок по дню скана (разбор отчета "Відправлено")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_ttn_cache_date ON ttn_cache (ship_date)")
+        conn.commit()
+        conn.close()
+
+    async def lookup(self, ttn_list):
+        """
+        Возвращает (hits, misses).
+        hits - {ttn: date или None} для ТТН, которые не нужно спрашивать у НП.
+        misses - список ТТН, которые надо (пере)проверить.
+        """
+        if not ttn_list:
+            return {}, []
+        stale_before = datetime.now() - timedelta(minutes=PENDING_TTL_MINUTES)
+        return await get_db().read(_lookup, list(ttn_list), stale_before)
+
+    async def store(self, results):
+        """results - {ttn: (date или None, resolved)}."""
+        if not results:
+            return
+        now = datetime.now().isoformat()
+        await get_db().write(_store, [
+            (ttn, ship_date.strftime("%Y-%m-%d") if ship_date else None, int(resolved), now)
+            for ttn, (ship_date, resolved) in results.items()
+        ])